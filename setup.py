@@ -2,14 +2,21 @@
 
 # pylint: disable=missing-docstring,invalid-name,line-too-long,bad-continuation,too-many-lines
 
+import abc
+import argparse
+import atexit
+import base64
 from contextlib import contextmanager
 import enum
-from functools import partial
+from functools import lru_cache, partial
+import hashlib
+import json
 import os
-from pathlib import Path
 import re
+import shutil
 import subprocess
 import sys
+import time
 import typing as t
 
 # Dynamic params, which can be set from env vars:
@@ -18,6 +25,34 @@ POSTGRES_USER = os.getenv("POSTGRES_USER", "django_user")
 # (don't worry, we will generate a secure password on the fly if needed :-)
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "")
 NGINX_SERVER_NAME = os.getenv("NGINX_SERVER_NAME", "")
+# Nginx "micro-caching" of anonymous responses, in seconds (0 means disabled):
+NGINX_MICROCACHE_SECONDS = int(os.getenv("NGINX_MICROCACHE_SECONDS", "0"))
+# HTTPS (with HTTP/2) is enabled when a certificate and its key are given - or when we are
+# asked to generate a self-signed one, which is only good for testing:
+NGINX_TLS_SELF_SIGNED = os.getenv("NGINX_TLS_SELF_SIGNED", "") == "1"
+NGINX_TLS_CERTIFICATE_PATH = os.getenv(
+    "NGINX_TLS_CERTIFICATE_PATH",
+    "/etc/ssl/certs/django-app-self-signed.pem" if NGINX_TLS_SELF_SIGNED else "",
+)
+NGINX_TLS_CERTIFICATE_KEY_PATH = os.getenv(
+    "NGINX_TLS_CERTIFICATE_KEY_PATH",
+    "/etc/ssl/private/django-app-self-signed.key" if NGINX_TLS_SELF_SIGNED else "",
+)
+NGINX_TLS_ENABLED = bool(NGINX_TLS_CERTIFICATE_PATH and NGINX_TLS_CERTIFICATE_KEY_PATH)
+# Machine-readable reports of the run, in addition to the one printed on stdout:
+REPORT_JSON_EVENTS_PATH = os.getenv("REPORT_JSON_EVENTS_PATH", "")
+REPORT_PROMETHEUS_TEXTFILE_PATH = os.getenv("REPORT_PROMETHEUS_TEXTFILE_PATH", "")
+# Size of the swap file, in MB (default: sized from the RAM; "0" means no swap file):
+SWAP_SIZE_MB = os.getenv("SWAP_SIZE_MB", "")
+# Set it to "1" to also have compressed swap in RAM, with zram:
+ZRAM_ENABLED = os.getenv("ZRAM_ENABLED", "") == "1"
+# Set it to "1" to install the Prometheus exporters and enable the status endpoints:
+MONITORING_ENABLED = os.getenv("MONITORING_ENABLED", "") == "1"
+# Queries slower than that are logged by Postgres when the monitoring is enabled:
+POSTGRES_LOG_MIN_DURATION_MS = int(os.getenv("POSTGRES_LOG_MIN_DURATION_MS", "250"))
+# "off" makes the writes faster, at the cost of losing the last few hundred milliseconds of
+# commits if the server crashes (but it never corrupts the database):
+POSTGRES_SYNCHRONOUS_COMMIT = os.getenv("POSTGRES_SYNCHRONOUS_COMMIT", "on")
 
 TARGET_DISTRIBUTION = "Ubuntu 18.04"
 TARGET_PYTHON_VERSION = "3.7"
@@ -33,6 +68,25 @@ LINUX_USER_DJANGO_GROUPNAME = os.getenv("LINUX_USER_DJANGO_GROUPNAME", "www-data
 
 DJANGO_APP_DIR = f"/home/{LINUX_USER_DJANGO_USERNAME}/django-app/current"
 DJANGO_PROJECT_NAME = "project"
+# Outside of the "current" app folder, so that it survives app symlinks updates:
+DJANGO_APP_VENV_DIR = f"/home/{LINUX_USER_DJANGO_USERNAME}/django-app/venv"
+DJANGO_APP_PIP_CACHE_DIR = f"/home/{LINUX_USER_DJANGO_USERNAME}/django-app/.pip-cache"
+DJANGO_APP_YARN_CACHE_DIR = f"/home/{LINUX_USER_DJANGO_USERNAME}/django-app/.yarn-cache"
+DJANGO_APP_STATIC_DIR = f"{DJANGO_APP_DIR}/static"
+# Where `yarn build` outputs the frontend assets, relatively to the app folder:
+FRONTEND_BUILD_DIR = os.getenv("FRONTEND_BUILD_DIR", "dist")
+# How many times the commands which download things (apt, pip, curl...) are retried,
+# with an exponential backoff, before we give up:
+NETWORK_RETRIES = int(os.getenv("NETWORK_RETRIES", "3"))
+
+# Where we keep track of the files we manage, and of the services waiting for a restart:
+MANAGED_FILES_STATE_PATH = "/var/lib/django-app-setup/managed-files.json"
+# Written at the end of the `bake` command: `personalize` only works on a baked image.
+BAKED_IMAGE_MARK_PATH = "/var/lib/django-app-setup/baked-image.json"
+# The steps completed by the previous run, from which `--resume` restarts:
+SETUP_CHECKPOINTS_PATH = "/var/lib/django-app-setup/checkpoints.json"
+# Passenger starts the app with a plain `python3.7` (no "-O"), so that's the bytecode it looks for:
+PASSENGER_PYTHON_OPTIMIZATION_LEVEL = 0
 
 # @link https://www.digitalocean.com/community/tutorials/how-to-set-up-django-with-postgres-nginx-and-gunicorn-on-ubuntu-18-04
 # @link https://www.digitalocean.com/community/tutorials/initial-server-setup-with-ubuntu-18-04
@@ -42,24 +96,193 @@ DJANGO_PROJECT_NAME = "project"
 ##################
 
 
-def setup_server() -> None:
+class SetupPhase(enum.Enum):
+    # What can be done once in a "golden" image, shared by all the servers booted from it:
+    BAKE = "bake"
+    # What is specific to each server: SSH keys, IP address, passwords, server name, RAM...
+    PERSONALIZE = "personalize"
+
+
+SetupStep = t.Tuple[SetupPhase, t.Callable[[], None], t.Callable[[], bool]]
+
+
+def setup_steps() -> t.List[SetupStep]:
+    """
+    Each step comes with a cheap check of its post-conditions (no network, hardly any
+    subprocess), which `--resume` uses to make sure that a step completed by a previous
+    run is still done before skipping it.
+    """
+    is_file = _executor.is_file
+    steps: t.List[SetupStep] = [
+        (SetupPhase.BAKE, ensure_firewall, firewall_is_enabled),
+        (
+            SetupPhase.BAKE,
+            ensure_linux_users_setup,
+            lambda: has_linux_user(LINUX_USER_SSH_USERNAME)
+            and has_linux_user(LINUX_USER_DJANGO_USERNAME),
+        ),
+        (
+            SetupPhase.PERSONALIZE,
+            ensure_linux_users_ssh_keys,
+            lambda: is_file(f"/home/{LINUX_USER_SSH_USERNAME}/.ssh/authorized_keys"),
+        ),
+        (
+            SetupPhase.BAKE,
+            ensure_base_software,
+            lambda: is_file("/usr/bin/curl") and is_file("/usr/bin/git"),
+        ),
+        (
+            SetupPhase.BAKE,
+            ensure_python,
+            lambda: is_file(f"/usr/bin/python{TARGET_PYTHON_VERSION}"),
+        ),
+        (
+            SetupPhase.BAKE,
+            ensure_nodejs,
+            lambda: is_file("/usr/local/bin/node") and is_file("/usr/bin/yarn"),
+        ),
+        (
+            SetupPhase.BAKE,
+            ensure_postgres,
+            lambda: is_file(
+                f"/usr/lib/postgresql/{TARGET_POSTGRES_VERSION}/bin/postgres"
+            ),
+        ),
+        (
+            SetupPhase.BAKE,
+            ensure_postgres_tuning,
+            lambda: check_file_content(
+                f"{_POSTGRES_CONF_DIR}/tuning.conf", _postgres_tuning_conf_file()
+            ),
+        ),
+        (SetupPhase.BAKE, ensure_nginx, lambda: is_file("/usr/sbin/nginx")),
+        (
+            SetupPhase.BAKE,
+            ensure_passenger,
+            lambda: is_file("/usr/bin/passenger-config"),
+        ),
+        # (the swap file is sized from the server RAM and disk)
+        (
+            SetupPhase.PERSONALIZE,
+            ensure_memory_tuning,
+            lambda: check_file_content(_MEMORY_SYSCTL_FILE_PATH, _memory_sysctl_file()),
+        ),
+        (
+            SetupPhase.PERSONALIZE,
+            ensure_postgres_django_setup,
+            lambda: db_user_exists(POSTGRES_USER),
+        ),
+        (
+            SetupPhase.BAKE,
+            ensure_python_app_packages_setup,
+            lambda: python_app_packages_synced(DJANGO_APP_DIR, DJANGO_APP_VENV_DIR),
+        ),
+        (
+            SetupPhase.BAKE,
+            ensure_django_app,
+            lambda: is_file(f"{DJANGO_APP_DIR}/{DJANGO_PROJECT_NAME}/wsgi.py"),
+        ),
+        (
+            SetupPhase.PERSONALIZE,
+            ensure_django_allowed_hosts,
+            lambda: not django_has_blank_allowed_hosts(
+                DJANGO_APP_DIR, DJANGO_PROJECT_NAME
+            ),
+        ),
+        (
+            SetupPhase.BAKE,
+            ensure_python_bytecode,
+            lambda: python_bytecode_compiled(DJANGO_APP_DIR, DJANGO_APP_VENV_DIR),
+        ),
+        (
+            SetupPhase.BAKE,
+            ensure_frontend_assets,
+            lambda: frontend_assets_published(DJANGO_APP_DIR, DJANGO_APP_STATIC_DIR),
+        ),
+        (
+            SetupPhase.PERSONALIZE,
+            ensure_nginx_and_passenger_setup,
+            lambda: check_file_content(
+                f"{_NGINX_ENABLED_SITES_PATH}/{_NGINX_SITE_NAME}", _nginx_site_file()
+            ),
+        ),
+    ]
+    if MONITORING_ENABLED:
+        # (the packages are downloaded once in the image, while the exporters config and
+        # the Postgres role are set up on each server - which needs the app database)
+        steps.append(
+            (
+                SetupPhase.BAKE,
+                ensure_monitoring_packages,
+                lambda: is_debian_package_installed("prometheus-node-exporter")
+                and is_debian_package_installed("prometheus-postgres-exporter"),
+            )
+        )
+        steps.append(
+            (
+                SetupPhase.PERSONALIZE,
+                ensure_monitoring,
+                lambda: check_file_content(
+                    "/etc/default/prometheus-postgres-exporter",
+                    _postgres_exporter_defaults_file(),
+                ),
+            )
+        )
+    return steps
+
+
+def setup_server(
+    phases: t.Collection[SetupPhase] = (SetupPhase.BAKE, SetupPhase.PERSONALIZE),
+    resume: bool = False,
+) -> None:
     flight_precheck()
 
-    ensure_firewall()
-    ensure_linux_users_setup()
+    completed_steps = setup_checkpoints_read() if resume else []
+    for phase, ensure_step, check_step_done in setup_steps():
+        if phase not in phases:
+            continue
+        step_name = ensure_step.__name__
+        if resume and step_name in completed_steps and check_step_done():
+            _report(f"Step '{step_name}' completed by a previous run, skipping it.")
+            continue
+        # From the first incomplete step on, we run every step again
+        resume = False
+        ensure_step()
+        if step_name not in completed_steps:
+            completed_steps.append(step_name)
+        setup_checkpoints_write(completed_steps)
 
-    ensure_base_software()
-    ensure_python()
-    ensure_nodejs()
-    ensure_postgres()
-    ensure_nginx()
-    ensure_passenger()
+    ensure_notified_services()
 
-    ensure_postgres_django_setup()
-    ensure_python_app_packages_setup()
 
-    ensure_django_app()
-    ensure_nginx_and_passenger_setup()
+def bake_image(resume: bool = False) -> None:
+    setup_server(phases=(SetupPhase.BAKE,), resume=resume)
+    ensure_image_cleaned_and_marked()
+
+
+def personalize_server(resume: bool = False) -> None:
+    if not _executor.is_file(BAKED_IMAGE_MARK_PATH):
+        _panic(
+            "This server was not booted from a baked image: run the whole setup instead."
+        )
+    setup_server(phases=(SetupPhase.PERSONALIZE,), resume=resume)
+
+
+def print_plan(
+    phases: t.Collection[SetupPhase] = (SetupPhase.BAKE, SetupPhase.PERSONALIZE)
+) -> None:
+    """
+    Lists the steps that the setup would run, without checking nor changing anything:
+    it doesn't spawn a single subprocess, so it's also our startup time benchmark.
+    """
+    completed_steps = setup_checkpoints_read()
+    steps = [step for step in setup_steps() if step[0] in phases]
+    for number, (phase, ensure_step, _) in enumerate(steps, start=1):
+        step_name = ensure_step.__name__
+        completed = (
+            " (completed by a previous run)" if step_name in completed_steps else ""
+        )
+        print(f"{number:2}. [{phase.value}] {step_name}{completed}")
 
 
 def flight_precheck() -> None:
@@ -98,15 +321,19 @@ def ensure_linux_users_setup() -> None:
     with _ensuring_step("Linux users"):
         if not has_linux_user(LINUX_USER_SSH_USERNAME):
             create_linux_user(
-                LINUX_USER_SSH_USERNAME,
-                LINUX_USER_SSH_GROUPNAME,
-                sudoer=True,
-                with_root_ssh_authorised_keys=True,
+                LINUX_USER_SSH_USERNAME, LINUX_USER_SSH_GROUPNAME, sudoer=True
             )
         if not has_linux_user(LINUX_USER_DJANGO_USERNAME):
             create_linux_user(LINUX_USER_DJANGO_USERNAME, LINUX_USER_DJANGO_GROUPNAME)
 
 
+def ensure_linux_users_ssh_keys() -> None:
+    with _ensuring_step("Linux users SSH keys"):
+        linux_user_copy_root_ssh_authorised_keys_if_needed(
+            LINUX_USER_SSH_USERNAME, LINUX_USER_SSH_GROUPNAME
+        )
+
+
 def ensure_base_software() -> None:
     with _ensuring_step("Curl"):
         install_debian_package_if_needed("curl")
@@ -120,6 +347,7 @@ def ensure_python() -> None:
     with _ensuring_step("Python"):
         install_ppa_if_needed("deadsnakes")
         install_debian_package_if_needed(f"python{TARGET_PYTHON_VERSION}")
+        install_debian_package_if_needed(f"python{TARGET_PYTHON_VERSION}-venv")
         _check_cmd_output_or_die(
             [f"python{TARGET_PYTHON_VERSION}", "--version"],
             r"^Python " + re.escape(TARGET_PYTHON_VERSION),
@@ -146,7 +374,7 @@ def ensure_nodejs() -> None:
             if installed:
                 nodejs_step.nothing_to_do("Node.js target version already installed.")
             else:
-                nodejs_step.done("Node.js target version not installed.")
+                nodejs_step.checked("Node.js target version not installed.")
                 nodejs_install()
 
         with _step("Checking Yarn status...") as yarn_step:
@@ -154,7 +382,7 @@ def ensure_nodejs() -> None:
             if installed:
                 yarn_step.nothing_to_do("Yarn already installed.")
             else:
-                yarn_step.done("Yarn not installed.")
+                yarn_step.checked("Yarn not installed.")
                 nodejs_install_yarn()
 
 
@@ -173,6 +401,22 @@ def ensure_postgres() -> None:
         )
 
 
+def ensure_postgres_tuning() -> None:
+    with _ensuring_step("Postgres tuning"):
+        if POSTGRES_SYNCHRONOUS_COMMIT not in _POSTGRES_SYNCHRONOUS_COMMIT_VALUES:
+            _panic(
+                f"POSTGRES_SYNCHRONOUS_COMMIT must be one of {', '.join(_POSTGRES_SYNCHRONOUS_COMMIT_VALUES)}"
+            )
+        # ("shared_preload_libraries" and "autovacuum_max_workers" changes need a full restart)
+        create_file_if_needed(
+            f"{_POSTGRES_CONF_DIR}/tuning.conf",
+            _postgres_tuning_conf_file(),
+            owner="postgres:postgres",
+            notify=["postgresql"],
+            restart=True,
+        )
+
+
 def ensure_nginx() -> None:
     with _ensuring_step("Nginx"):
         install_debian_package_if_needed("nginx")
@@ -192,7 +436,9 @@ def ensure_passenger() -> None:
             "passenger",
             "Phusion Automated Software Signing",
         )
-        install_debian_package_if_needed("libnginx-mod-http-passenger")
+        if install_debian_package_if_needed("libnginx-mod-http-passenger"):
+            # (a new Nginx module is not loaded by a mere reload)
+            managed_files_notify(["nginx"], restart=True)
         _check_cmd_output_or_die(
             "/usr/bin/passenger-config validate-install --auto | tail -n 1",
             r"Everything looks good",
@@ -200,16 +446,59 @@ def ensure_passenger() -> None:
         )
 
 
+def ensure_memory_tuning() -> None:
+    with _ensuring_step("Memory tuning"):
+        swap_size_mb = (
+            int(SWAP_SIZE_MB)
+            if SWAP_SIZE_MB
+            else memory_swap_size_mb(
+                read_meminfo().get("MemTotal", 0) // 1024,
+                _executor.disk_free_bytes(_SWAP_FILE_PATH) // (1024 * 1024),
+            )
+        )
+        if swap_size_mb:
+            memory_create_swap_file_if_needed(_SWAP_FILE_PATH, swap_size_mb)
+            memory_add_swap_file_to_fstab_if_needed(_SWAP_FILE_PATH)
+        sysctl_changed = create_file_if_needed(
+            _MEMORY_SYSCTL_FILE_PATH, _memory_sysctl_file()
+        )
+        if sysctl_changed:
+            memory_apply_sysctl(_MEMORY_SYSCTL_FILE_PATH)
+        if ZRAM_ENABLED:
+            # (the package enables and starts its oneshot service by itself)
+            install_debian_package_if_needed("zram-config")
+
+        # When the memory runs out, the kernel should kill app workers rather than Postgres
+        # (the OOM score of the running processes only changes when they are restarted)
+        systemd_create_drop_in_file_if_needed(
+            f"postgresql@{TARGET_POSTGRES_VERSION}-main",
+            "memory",
+            _postgres_memory_drop_in_file(),
+            notify=["postgresql"],
+            restart=True,
+        )
+        systemd_create_drop_in_file_if_needed(
+            "nginx",
+            "memory",
+            _nginx_memory_drop_in_file(),
+            notify=["nginx"],
+            restart=True,
+        )
+
+
 def ensure_postgres_django_setup() -> None:
     with _ensuring_step("Posgres config for the Django app"):
         postgres_django_setup_ensure_db(POSTGRES_DB)
         postgres_django_setup_ensure_user(POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_DB)
+        # The app role can then see the statistics of its own queries (see `db-report`)
+        postgres_ensure_extension("pg_stat_statements", POSTGRES_DB)
 
 
 def ensure_python_app_packages_setup() -> None:
     with _ensuring_step("Python packages for our app"):
-        install_python_package_if_needed("psycopg2-binary")
         install_python_package_if_needed("pipenv")
+        python_create_venv_if_needed(DJANGO_APP_VENV_DIR)
+        python_app_sync_packages(DJANGO_APP_DIR, DJANGO_APP_VENV_DIR)
 
 
 def ensure_django_app() -> None:
@@ -217,22 +506,135 @@ def ensure_django_app() -> None:
         create_blank_django_app_if_needed(DJANGO_APP_DIR, DJANGO_PROJECT_NAME)
 
 
+def ensure_django_allowed_hosts() -> None:
+    with _ensuring_step("Django allowed hosts"):
+        django_set_allowed_hosts_if_needed(DJANGO_APP_DIR, DJANGO_PROJECT_NAME)
+
+
+def ensure_python_bytecode() -> None:
+    with _ensuring_step("Python bytecode"):
+        python_compile_site_packages(f"{DJANGO_APP_VENV_DIR}/bin/python")
+        python_compile_app(DJANGO_APP_DIR)
+        # (only recorded once everything is compiled: a compilation that died halfway
+        # is not mistaken for a complete one by `--resume`)
+        create_file_if_needed(
+            f"{DJANGO_APP_VENV_DIR}/{_PYTHON_COMPILED_SOURCES_HASH_FILE_NAME}",
+            python_sources_hash(DJANGO_APP_DIR),
+        )
+
+
+def ensure_frontend_assets() -> None:
+    with _ensuring_step("Frontend assets"):
+        frontend_build_assets_if_needed(DJANGO_APP_DIR, DJANGO_APP_STATIC_DIR)
+
+
 def ensure_nginx_and_passenger_setup() -> None:
     with _ensuring_step("Nginx & Passenger setup"):
         with _ensuring_step("Passenger setup"):
             passenger_wsgi_path = f"{DJANGO_APP_DIR}/passenger_wsgi.py"
-            create_file_if_needed(passenger_wsgi_path, _PASSENGER_WSGI_FILE)
-        with _ensuring_step("Nginx setup"):
             create_file_if_needed(
-                f"{_NGINX_AVAILABLE_SITES_PATH}/{_NGINX_SITE_NAME}", _NGINX_SITE_FILE
+                passenger_wsgi_path,
+                _passenger_wsgi_file(),
+                owner=f"{LINUX_USER_DJANGO_USERNAME}:{LINUX_USER_DJANGO_GROUPNAME}",
+                notify=["nginx"],
+            )
+        if NGINX_TLS_ENABLED:
+            with _ensuring_step("Nginx TLS certificate"):
+                if NGINX_TLS_SELF_SIGNED:
+                    nginx_create_self_signed_certificate_if_needed(
+                        NGINX_TLS_CERTIFICATE_PATH, NGINX_TLS_CERTIFICATE_KEY_PATH
+                    )
+                for path in (
+                    NGINX_TLS_CERTIFICATE_PATH,
+                    NGINX_TLS_CERTIFICATE_KEY_PATH,
+                ):
+                    if not _executor.is_file(path):
+                        _panic(f"TLS certificate file '{path}' not found.")
+        with _ensuring_step("Nginx setup"):
+            if NGINX_MICROCACHE_SECONDS:
+                nginx_microcache_ensure_dir(_NGINX_MICROCACHE_PATH)
+            site_changed = create_file_if_needed(
+                f"{_NGINX_AVAILABLE_SITES_PATH}/{_NGINX_SITE_NAME}",
+                _nginx_site_file(),
+                notify=["nginx"],
             )
-            nginx_activate_nginx_site_if_needed(
+            site_activated = nginx_activate_nginx_site_if_needed(
                 available_sites_path=_NGINX_AVAILABLE_SITES_PATH,
                 enabled_sites_path=_NGINX_ENABLED_SITES_PATH,
                 site_name=_NGINX_SITE_NAME,
-                site_config=_NGINX_SITE_FILE,
+                site_config=_nginx_site_file(),
             )
-            systemd_enable_and_start_service("nginx")
+            if site_activated:
+                managed_files_notify(["nginx"])
+            elif site_changed:
+                # (the activation already checks it)
+                nginx_check_config_or_die()
+
+
+def ensure_monitoring_packages() -> None:
+    with _ensuring_step("Monitoring packages"):
+        install_debian_package_if_needed("prometheus-node-exporter")
+        install_debian_package_if_needed("prometheus-postgres-exporter")
+
+
+def ensure_monitoring() -> None:
+    with _ensuring_step("Monitoring"):
+        # Every exporter and status endpoint only listens on localhost: they are meant to be
+        # scraped through a SSH tunnel, or by a Prometheus server running on this host.
+        with _ensuring_step("Node exporter"):
+            monitoring_setup_exporter(
+                "prometheus-node-exporter",
+                _node_exporter_defaults_file(),
+                _NODE_EXPORTER_PORT,
+            )
+        with _ensuring_step("Postgres exporter"):
+            postgres_monitoring_setup()
+            monitoring_setup_exporter(
+                "prometheus-postgres-exporter",
+                _postgres_exporter_defaults_file(),
+                _POSTGRES_EXPORTER_PORT,
+            )
+        with _ensuring_step("Nginx status"):
+            nginx_status_site_path = (
+                f"{_NGINX_AVAILABLE_SITES_PATH}/{_NGINX_STATUS_SITE_NAME}"
+            )
+            create_file_if_needed(
+                nginx_status_site_path, _nginx_status_site_file(), notify=["nginx"]
+            )
+            if nginx_activate_nginx_site_if_needed(
+                available_sites_path=_NGINX_AVAILABLE_SITES_PATH,
+                enabled_sites_path=_NGINX_ENABLED_SITES_PATH,
+                site_name=_NGINX_STATUS_SITE_NAME,
+                site_config=_nginx_status_site_file(),
+            ):
+                managed_files_notify(["nginx"])
+            firewall_rule_deny_if_needed(_NGINX_STATUS_PORT)
+
+
+def ensure_image_cleaned_and_marked() -> None:
+    with _ensuring_step("Image cleanup"):
+        image_clean_caches()
+        image_mark_as_baked(BAKED_IMAGE_MARK_PATH)
+
+
+def ensure_notified_services() -> None:
+    with _ensuring_step("Services reloads"):
+        if _managed_files.daemon_reload_pending():
+            systemd_daemon_reload()
+            _managed_files.daemon_reload_done()
+        # Each service gets at most one reload (or restart), whatever the number of its
+        # files that changed: config-only changes get a graceful reload, which doesn't
+        # drop the in-flight connections.
+        notifications = managed_files_pending_notifications()
+        for service_name, restart in notifications:
+            if service_name == "nginx":
+                nginx_check_config_or_die()
+            systemd_apply_service_changes(service_name, restart=restart)
+            managed_files_notification_done(service_name)
+        notified_services = {service_name for service_name, _ in notifications}
+        for service_name in ("postgresql", "nginx"):
+            if service_name not in notified_services:
+                systemd_check_service_is_active_or_die(service_name)
 
 
 ##################
@@ -253,7 +655,7 @@ def firewall_is_enabled() -> bool:
         is_active = process_result.success and process_result.stdout_starts_with(
             "Status: active"
         )
-        step.done(f"Checked ({'active' if is_active else 'inactive'}).")
+        step.checked(f"Checked ({'active' if is_active else 'inactive'}).")
         return is_active
 
 
@@ -288,17 +690,21 @@ def firewall_rule_check_status(rule: str) -> FirewallRuleStatus:
                 f"^{rule}\\s+{FirewallRuleStatus.DENY.value}"
             ):
                 status = FirewallRuleStatus.DENY
-        step.done(f"Firewall rule checked ({status.value}).")
+        step.checked(f"Firewall rule checked ({status.value}).")
         return status
 
 
 def firewall_rule_allow(rule: str, check: bool = True) -> None:
     with _step(f"Allowing firewall rule '{rule}'...") as step:
         cmd = ["ufw", "allow", rule]
-        _run(cmd)
+        process_result = _run(cmd)
         if check and firewall_rule_check_status(rule) is not FirewallRuleStatus.ALLOW:
             _panic("Couldn't allow the firewall rule!")
-        step.done("Firewall rule allowed.")
+        # (ufw doesn't add a rule twice, and tells so)
+        if process_result.stdout_matches("^Skipping"):
+            step.nothing_to_do("Firewall rule already allowed.")
+        else:
+            step.done("Firewall rule allowed.")
 
 
 def firewall_rule_allow_if_needed(rule: str) -> bool:
@@ -309,6 +715,23 @@ def firewall_rule_allow_if_needed(rule: str) -> bool:
     return True
 
 
+def firewall_rule_deny(rule: str) -> None:
+    with _step(f"Denying firewall rule '{rule}'...") as step:
+        cmd = ["ufw", "deny", rule]
+        _run(cmd)
+        if firewall_rule_check_status(rule) is not FirewallRuleStatus.DENY:
+            _panic("Couldn't deny the firewall rule!")
+        step.done("Firewall rule denied.")
+
+
+def firewall_rule_deny_if_needed(rule: str) -> bool:
+    firewall_rule_status = firewall_rule_check_status(rule)
+    if firewall_rule_status is FirewallRuleStatus.DENY:
+        return False
+    firewall_rule_deny(rule)
+    return True
+
+
 def is_debian_package_installed(name: str) -> bool:
     with _step(
         f"Checking if the Debian package '{name}' is already installed..."
@@ -324,7 +747,7 @@ def is_debian_package_installed(name: str) -> bool:
         if installed:
             step.nothing_to_do("Debian package already installed.")
         else:
-            step.done("Debian package not installed.")
+            step.checked("Debian package not installed.")
         return installed
 
 
@@ -336,7 +759,7 @@ def is_ppa_installed(name: str) -> bool:
         if installed:
             step.nothing_to_do("PPA already installed.")
         else:
-            step.done("PPA not installed.")
+            step.checked("PPA not installed.")
         return installed
 
 
@@ -348,14 +771,14 @@ def is_apt_repository_installed(expected_repo_name: str) -> bool:
         if installed:
             step.nothing_to_do("APT repository already installed.")
         else:
-            step.done("APT repository not installed.")
+            step.checked("APT repository not installed.")
         return installed
 
 
 def install_ppa(name: str) -> None:
     with _step(f"Adding PPA '{name}'...") as step:
         cmd = ["add-apt-repository", "-y", f"ppa:{name}/ppa"]
-        _run(cmd, stdout=None)
+        _run_network(cmd, stdout=None)
         apt_update()
         step.done("PPA added.")
 
@@ -376,7 +799,7 @@ def add_apt_repository(
             "--recv-keys",
             key,
         ]
-        _run(apt_key_cmd, stdout=None)
+        _run_network(apt_key_cmd, stdout=None)
         create_file_if_needed(
             f"/etc/apt/sources.list.d/{repo_name.lower()}.list", deb_definition
         )
@@ -385,7 +808,7 @@ def add_apt_repository(
 
 
 def is_root() -> bool:
-    return os.geteuid() == 0
+    return _executor.geteuid() == 0
 
 
 def check_distrib() -> bool:
@@ -427,41 +850,43 @@ def install_debian_package_if_needed(name: str) -> bool:
 def apt_update() -> None:
     with _step("Updating APT repositories...") as step:
         cmd = ["apt", "update"]
-        _run(cmd)
+        _run_network(cmd)
         step.done("Updated.")
 
 
 def apt_install(name: str) -> None:
     with _step(f"Installing Debian package '{name}'...") as step:
         cmd = ["apt", "install", "-y", name]
-        _run(cmd)
+        _run_network(cmd)
         step.done("Installed.")
 
 
-def is_python_package_installed(name: str) -> bool:
+def is_python_package_installed(name: str, pip: t.Sequence[str] = ("pip",)) -> bool:
     with _step(f"Checking Python package '{name}'...") as step:
-        cmd = f"pip list | grep '{name} '"
-        process_result = _run(cmd, panic_on_error=False, shell=True)
-        installed = process_result.success and process_result.stdout_starts_with(name)
+        # (`pip show` matches the package names case-insensitively: pip prints "Django")
+        cmd = [*pip, "show", name]
+        installed = _run(cmd, panic_on_error=False).success
         if installed:
             step.nothing_to_do("Python package already installed.")
         else:
-            step.done("Python package not installed.")
+            step.checked("Python package not installed.")
         return installed
 
 
-def install_python_package_if_needed(name: str) -> bool:
-    installed = is_python_package_installed(name)
+def install_python_package_if_needed(
+    name: str, pip: t.Sequence[str] = ("pip",)
+) -> bool:
+    installed = is_python_package_installed(name, pip=pip)
     if installed:
         return False
-    install_python_package(name)
+    install_python_package(name, pip=pip)
     return True
 
 
-def install_python_package(name: str) -> None:
+def install_python_package(name: str, pip: t.Sequence[str] = ("pip",)) -> None:
     with _step(f"Installing Python package '{name}'...") as step:
-        cmd = ["pip", "install", name]
-        _run(cmd)
+        cmd = [*pip, "install", name]
+        _run_network(cmd)
         step.done("Installed.")
 
 
@@ -473,16 +898,12 @@ def has_linux_user(user: str) -> bool:
         if user_exists:
             step.nothing_to_do("User checked (already exists).")
         else:
-            step.done("User checked (doesn't exist').")
+            step.checked("User checked (doesn't exist).")
         return user_exists
 
 
 def create_linux_user(
-    user: str,
-    group: str,
-    shell: str = "/bin/bash",
-    sudoer: bool = False,
-    with_root_ssh_authorised_keys: bool = False,
+    user: str, group: str, shell: str = "/bin/bash", sudoer: bool = False
 ) -> None:
     with _step(
         f"Creating Linux user '{user}:{group}', with shell '{shell}'..."
@@ -498,56 +919,118 @@ def create_linux_user(
                 add_to_sudoers_cmd = ["usermod", "-aG" "sudo", user]
                 _run(add_to_sudoers_cmd)
                 sudoer_step.done("Added.")
-        if with_root_ssh_authorised_keys:
-            with _step(
-                f"Giving this user the same '~/.ssh/authorized_keys' than the root user..."
-            ) as ssh_authorised_keys_step:
-                target_file_dir = f"/home/{user}/.ssh"
-                copy_keys_cmd = f"mkdir -p '{target_file_dir}' && cp '/root/.ssh/authorized_keys' '{target_file_dir}/' && chown -R '{user}:{group}' '{target_file_dir}'"
-                _run(copy_keys_cmd, shell=True)
-                ssh_authorised_keys_step.done(
-                    "'Authorised keys' copied from root user."
-                )
 
         step.done("Created.")
 
 
+def linux_user_copy_root_ssh_authorised_keys_if_needed(user: str, group: str) -> bool:
+    with _step(
+        f"Giving the user '{user}' the same '~/.ssh/authorized_keys' than the root user..."
+    ) as step:
+        try:
+            root_authorised_keys = _executor.read_text("/root/.ssh/authorized_keys")
+        except FileNotFoundError:
+            step.nothing_to_do("The root user has no 'authorised keys'.")
+            return False
+        target_file_dir = f"/home/{user}/.ssh"
+        _executor.makedirs(target_file_dir)
+        _executor.chown(target_file_dir, f"{user}:{group}")
+        _executor.chmod(target_file_dir, 0o700)
+        keys_copied = create_file_if_needed(
+            f"{target_file_dir}/authorized_keys",
+            root_authorised_keys,
+            owner=f"{user}:{group}",
+            mode=0o600,
+        )
+        if keys_copied:
+            step.done("'Authorised keys' copied from root user.")
+        else:
+            step.nothing_to_do("'Authorised keys' already up to date.")
+        return keys_copied
+
+
 def check_file_content(path: str, expected_content: str) -> bool:
+    file_stat = _executor.stat(path)
+    if file_stat is None:
+        return False
+    expected_hash = hashlib.sha256(expected_content.encode("utf-8")).hexdigest()
+    if _managed_files.is_unchanged(path, expected_hash, file_stat):
+        # Same size and mtime than when we last saw it with that content: no need to read it
+        return True
     try:
-        with open(path, mode="r") as f:
-            return expected_content == f.read()
+        content_ok = expected_content == _executor.read_text(path)
     except FileNotFoundError:
         return False
-
-
-def create_file_if_needed(path: str, content: str) -> None:
+    if content_ok:
+        _managed_files.record(path, expected_hash, file_stat)
+    return content_ok
+
+
+def create_file_if_needed(
+    path: str,
+    content: str,
+    owner: t.Optional[str] = None,
+    mode: t.Optional[int] = None,
+    notify: t.Sequence[str] = (),
+    restart: bool = False,
+) -> bool:
+    """
+    Creates the file, unless it already has the expected content.
+    The services it "notifies" get reloaded at the end of the run if it changed
+    - or restarted, for the changes which can't be applied by a reload.
+    """
     with _step(
         f"Checking if the file '{path}' already exists and have the expected content..."
     ) as step:
         file_is_ok = check_file_content(path, content)
         if file_is_ok:
             step.nothing_to_do("No need to create it.")
-        else:
-            step.done("Ok, we have to (re?)create it.")
-            create_file(path, content)
+            return False
+        step.done("Ok, we have to (re?)create it.")
+        # (notified before the write, so that the restart is not lost if we crash in between)
+        managed_files_notify(notify, restart=restart)
+        create_file(path, content, owner=owner, mode=mode)
+        return True
 
 
-def create_file(path: str, content: str) -> None:
+def create_file(
+    path: str, content: str, owner: t.Optional[str] = None, mode: t.Optional[int] = None
+) -> None:
     with _step(f"Creating file '{path}'...") as step:
-        with open(path, mode="w") as f:
-            f.write(content)
+        _executor.write_text(path, content)
+        if owner:
+            _executor.chown(path, owner)
+        if mode is not None:
+            _executor.chmod(path, mode)
+        file_stat = _executor.stat(path)
+        if file_stat:
+            _managed_files.record(
+                path, hashlib.sha256(content.encode("utf-8")).hexdigest(), file_stat
+            )
         step.done(f"File created.")
 
 
+def managed_files_notify(service_names: t.Iterable[str], restart: bool = False) -> None:
+    for service_name in service_names:
+        _managed_files.notify(service_name, restart=restart)
+
+
+def managed_files_pending_notifications() -> t.List[t.Tuple[str, bool]]:
+    return _managed_files.pending_notifications()
+
+
+def managed_files_notification_done(service_name: str) -> None:
+    _managed_files.notification_done(service_name)
+
+
 def nginx_enable_site(
     available_sites_path: str, enabled_sites_path: str, site_name: str
 ) -> bool:
     site_available_path = f"{available_sites_path}/{site_name}"
     site_enabled_path = f"{enabled_sites_path}/{site_name}"
-    if (
-        Path(site_enabled_path).resolve() == site_available_path
-        and Path(site_available_path).is_file()
-    ):
+    if _executor.realpath(
+        site_enabled_path
+    ) == site_available_path and _executor.is_file(site_available_path):
         return False
 
     with _step(f"Enabling Nginx site '{site_name}'...") as step:
@@ -559,7 +1042,7 @@ def nginx_enable_site(
 
 def nginx_disable_site_if_needed(site_name: str) -> bool:
     nginx_site_path = f"{_NGINX_ENABLED_SITES_PATH}/{site_name}"
-    if not Path(nginx_site_path).is_symlink():
+    if not _executor.is_symlink(nginx_site_path):
         return False
 
     with _step(f"Disabling Nginx site '{site_name}'...") as step:
@@ -574,7 +1057,7 @@ def nginx_check_config() -> bool:
         check_cmd = ["nginx", "-t"]
         process_result = _run(check_cmd, panic_on_error=False)
         config_ok = process_result.success
-        step.done(f"Nginx config checked ({'ok' if config_ok else 'broken'}).")
+        step.checked(f"Nginx config checked ({'ok' if config_ok else 'broken'}).")
         return config_ok
 
 
@@ -585,38 +1068,82 @@ def nginx_check_config_or_die() -> None:
 
 
 def systemd_enable_and_start_service(service_name: str) -> None:
-    with _step(f"Enabling and starting Systemd service '{service_name}'...") as step:
+    systemd_apply_service_changes(service_name, restart=True)
 
-        with _step("Reloading Systemd...") as reloading_systemd_step:
-            systemd_reload_cmd = ["systemctl", "daemon-reload"]
-            _run(systemd_reload_cmd)
-            reloading_systemd_step.done("Systemd reloaded.")
 
-        with _step("Restarting Systemd service...") as restarting_service_step:
-            cmd = ["systemctl", "restart", service_name]
-            _run(cmd)
-            restarting_service_step.done("Service restarted.")
+def systemd_apply_service_changes(service_name: str, restart: bool) -> None:
+    action = "restart" if restart else "reload"
+    with _step(f"Enabling and {action}ing Systemd service '{service_name}'...") as step:
 
-        with _step("Enabling Systemd service...") as enabling_service_step:
-            cmd = ["systemctl", "enable", service_name]
+        with _step(f"{action.capitalize()}ing Systemd service...") as service_step:
+            # ("reload-or-restart" also starts the service if it's not running)
+            cmd = [
+                "systemctl",
+                "restart" if restart else "reload-or-restart",
+                service_name,
+            ]
             _run(cmd)
-            enabling_service_step.done("Service enabled.")
+            service_step.done(f"Service {action}ed.")
 
+        systemd_enable_service_if_needed(service_name)
         systemd_check_service_is_active_or_die(service_name)
 
-        step.done(f"Systemd service '{service_name}' enabled and started.")
+        step.done(f"Systemd service '{service_name}' enabled and {action}ed.")
+
+
+def systemd_enable_service_if_needed(service_name: str) -> bool:
+    with _step(f"Checking if Systemd service '{service_name}' is enabled...") as step:
+        cmd = ["systemctl", "is-enabled", service_name]
+        process_result = _run(cmd, panic_on_error=False)
+        if process_result.success and process_result.stdout_starts_with("enabled"):
+            step.nothing_to_do("Service already enabled.")
+            return False
+        step.checked("Service not enabled.")
+
+    with _step("Enabling Systemd service...") as enabling_service_step:
+        cmd = ["systemctl", "enable", service_name]
+        _run(cmd)
+        enabling_service_step.done("Service enabled.")
+        return True
+
+
+def systemd_daemon_reload() -> None:
+    with _step("Reloading Systemd...") as step:
+        cmd = ["systemctl", "daemon-reload"]
+        _run(cmd)
+        step.done("Systemd reloaded.")
+
+
+def systemd_create_drop_in_file_if_needed(
+    unit_name: str,
+    drop_in_name: str,
+    content: str,
+    notify: t.Sequence[str] = (),
+    restart: bool = False,
+) -> bool:
+    drop_in_dir = f"/etc/systemd/system/{unit_name}.service.d"
+    _executor.makedirs(drop_in_dir)
+    drop_in_changed = create_file_if_needed(
+        f"{drop_in_dir}/{drop_in_name}.conf", content, notify=notify, restart=restart
+    )
+    if drop_in_changed:
+        # Systemd only sees unit files changes after a "daemon-reload"
+        _managed_files.notify_daemon_reload()
+    return drop_in_changed
 
 
 def systemd_check_service_is_active(service_name: str) -> bool:
     with _step(
         f"Checking if Systemd service '{service_name}' is well and truly active..."
     ) as step:
-        cmd = ["systemctl", "status", service_name]
+        # (not "active (running)" in `systemctl status`: oneshot services such as the
+        # "postgresql" wrapper of the clusters units are "active (exited)")
+        cmd = ["systemctl", "is-active", service_name]
         process_result = _run(cmd, panic_on_error=False)
-        is_active = process_result.success and process_result.stdout_has_content(
-            "active (running)"
+        is_active = process_result.success and process_result.stdout_starts_with(
+            "active"
         )
-        step.done(f"Checking done ({'active' if is_active else 'not active'}).")
+        step.checked(f"Checking done ({'active' if is_active else 'not active'}).")
         return is_active
 
 
@@ -626,6 +1153,72 @@ def systemd_check_service_is_active_or_die(service_name: str) -> None:
         _panic(f"Service '{service_name}' is not active.")
 
 
+def read_meminfo() -> t.Dict[str, int]:
+    """Returns the "/proc/meminfo" values, in kB (an empty dict if it can't be read)"""
+    try:
+        meminfo_content = _executor.read_text("/proc/meminfo")
+    except FileNotFoundError:
+        return {}
+    return {
+        name: int(value)
+        for name, value in re.findall(r"^(\w+):\s+(\d+)", meminfo_content, flags=re.M)
+    }
+
+
+def memory_swap_size_mb(memory_total_mb: int, disk_free_mb: int) -> int:
+    # Twice the RAM for the small Droplets, as much as the RAM for the bigger ones,
+    # between 1GB and 4GB - but never more than a quarter of the free disk space.
+    swap_size_mb = memory_total_mb * 2 if memory_total_mb < 2048 else memory_total_mb
+    swap_size_mb = min(max(swap_size_mb, 1024), 4096)
+    return min(swap_size_mb, disk_free_mb // 4)
+
+
+def memory_is_swap_file_active(path: str) -> bool:
+    # "/proc/swaps" lines look like "/swapfile    file    2097148    0    -2"
+    try:
+        swaps = _executor.read_text("/proc/swaps")
+    except FileNotFoundError:
+        return False
+    return any(line.split()[0] == path for line in swaps.splitlines()[1:] if line)
+
+
+def memory_create_swap_file_if_needed(path: str, size_mb: int) -> bool:
+    with _step(f"Checking swap file '{path}'...") as step:
+        if memory_is_swap_file_active(path):
+            step.nothing_to_do("Swap file already active.")
+            return False
+        if not _executor.is_file(path):
+            step.wip(f"Creating a {size_mb}MB swap file...")
+            _run(["fallocate", "-l", f"{size_mb}M", path])
+            _run(["chmod", "600", path])
+            _run(["mkswap", path])
+        _run(["swapon", path])
+        if not memory_is_swap_file_active(path):
+            _panic("Could not activate the swap file")
+        step.done("Swap file active.")
+        return True
+
+
+def memory_add_swap_file_to_fstab_if_needed(path: str) -> bool:
+    with _step(f"Checking that the swap file is in '/etc/fstab'...") as step:
+        fstab = _executor.read_text("/etc/fstab")
+        if any(line.split()[:1] == [path] for line in fstab.splitlines()):
+            step.nothing_to_do("Swap file already in '/etc/fstab'.")
+            return False
+        fstab_line = f"{path} none swap sw 0 0\n"
+        create_file(
+            "/etc/fstab", fstab + ("" if fstab.endswith("\n") else "\n") + fstab_line
+        )
+        step.done("Swap file added to '/etc/fstab'.")
+        return True
+
+
+def memory_apply_sysctl(path: str) -> None:
+    with _step(f"Applying kernel parameters from '{path}'...") as step:
+        _run(["sysctl", "-p", path])
+        step.done("Kernel parameters applied.")
+
+
 def db_database_exists(db_name: str) -> bool:
     check_db_sql = f"""select datname from pg_database where datname = '{db_name}';"""
     result = _run_sql(check_db_sql)
@@ -638,6 +1231,14 @@ def db_user_exists(user: str) -> bool:
     return result is not None and result.find(user) > -1
 
 
+def db_extension_exists(extension: str, db_name: str) -> bool:
+    check_extension_sql = (
+        f"""select extname from pg_extension where extname = '{extension}';"""
+    )
+    result = _run_sql(check_extension_sql, db_name=db_name)
+    return result is not None and result.find(extension) > -1
+
+
 ##################
 # Step-specific functions
 ##################
@@ -646,7 +1247,7 @@ def db_user_exists(user: str) -> bool:
 def python_install_pip() -> None:
     with _step("Installing pip...") as step:
         dl_cmd = "curl -L -sS 'https://bootstrap.pypa.io/get-pip.py' -o get-pip.py"
-        _run(dl_cmd, shell=True)
+        _run_network(dl_cmd, shell=True)
         install_cmd = f"python{TARGET_PYTHON_VERSION} get-pip.py"
         _run(install_cmd, shell=True)
         step.done("pip installed.")
@@ -658,7 +1259,7 @@ def nodejs_install() -> None:
 curl 'https://nodejs.org/dist/v{TARGET_NODEJS_VERSION}/node-v{TARGET_NODEJS_VERSION}-linux-x64.tar.xz' \
 | sudo tar --file=- --extract --xz --directory /usr/local/ --strip-components=1 \
 """
-        _run(cmd, shell=True)
+        _run_network(cmd, shell=True)
         _check_cmd_output_or_die(
             ["node", "--version"], r"^v" + re.escape(TARGET_NODEJS_VERSION)
         )
@@ -674,11 +1275,442 @@ echo "deb https://dl.yarnpkg.com/debian/ stable main" | tee /etc/apt/sources.lis
 apt-get update && \
 apt install --no-install-recommends yarn
 """
-        _run(cmd, shell=True)
+        _run_network(cmd, shell=True)
         _check_cmd_output_or_die(["yarn", "--version"], r"^\d\.\d")
         step.done("Yarn installed.")
 
 
+def python_venv_pip_cmd(venv_dir: str) -> t.List[str]:
+    # The venv belongs to the Django user, so that's who must install packages in it
+    return [
+        "sudo",
+        "-u",
+        LINUX_USER_DJANGO_USERNAME,
+        "-H",
+        "env",
+        f"PIP_CACHE_DIR={DJANGO_APP_PIP_CACHE_DIR}",
+        f"{venv_dir}/bin/pip",
+    ]
+
+
+def python_create_venv_if_needed(venv_dir: str) -> bool:
+    with _step(f"Checking Python virtualenv '{venv_dir}'...") as step:
+        if _executor.is_file(f"{venv_dir}/bin/python{TARGET_PYTHON_VERSION}"):
+            step.nothing_to_do("Virtualenv exists.")
+            return False
+        for dir_path in (os.path.dirname(venv_dir), DJANGO_APP_PIP_CACHE_DIR):
+            _executor.makedirs(dir_path)
+            _run(
+                [
+                    "chown",
+                    f"{LINUX_USER_DJANGO_USERNAME}:{LINUX_USER_DJANGO_GROUPNAME}",
+                    dir_path,
+                ]
+            )
+        create_venv_cmd = [
+            "sudo",
+            "-u",
+            LINUX_USER_DJANGO_USERNAME,
+            f"python{TARGET_PYTHON_VERSION}",
+            "-m",
+            "venv",
+            venv_dir,
+        ]
+        _run(create_venv_cmd)
+        step.done("Virtualenv created.")
+        return True
+
+
+def python_app_lockfile(app_dir: str) -> t.Optional[str]:
+    for lockfile_name in ("Pipfile.lock", "requirements.txt"):
+        lockfile = f"{app_dir}/{lockfile_name}"
+        if _executor.is_file(lockfile):
+            return lockfile
+    return None
+
+
+def python_app_lockfile_hash(lockfile: str) -> str:
+    return hashlib.sha256(_executor.read_bytes(lockfile)).hexdigest()
+
+
+def python_app_packages_synced(app_dir: str, venv_dir: str) -> bool:
+    """Whether the virtualenv has the packages of the app lockfile, without syncing them"""
+    if not _executor.is_file(f"{venv_dir}/bin/python{TARGET_PYTHON_VERSION}"):
+        return False
+    lockfile = python_app_lockfile(app_dir)
+    if lockfile is None:
+        pip = python_venv_pip_cmd(venv_dir)
+        return all(
+            is_python_package_installed(name, pip=pip)
+            for name in _PYTHON_APP_DEFAULT_PACKAGES
+        )
+    return check_file_content(
+        f"{venv_dir}/{_PYTHON_SYNCED_LOCKFILE_HASH_FILE_NAME}",
+        python_app_lockfile_hash(lockfile),
+    )
+
+
+def python_app_sync_packages(app_dir: str, venv_dir: str) -> bool:
+    pip = python_venv_pip_cmd(venv_dir)
+    lockfile = python_app_lockfile(app_dir)
+    if lockfile is None:
+        # No lockfile (yet?), which is the case of our blank Django app:
+        # we just need Django and the Postgres driver.
+        packages_installed = [
+            install_python_package_if_needed(name, pip=pip)
+            for name in _PYTHON_APP_DEFAULT_PACKAGES
+        ]
+        return any(packages_installed)
+
+    with _step(f"Checking app packages from '{lockfile}'...") as step:
+        lockfile_hash = python_app_lockfile_hash(lockfile)
+        synced_lockfile_hash_path = (
+            f"{venv_dir}/{_PYTHON_SYNCED_LOCKFILE_HASH_FILE_NAME}"
+        )
+        if check_file_content(synced_lockfile_hash_path, lockfile_hash):
+            step.nothing_to_do("Lockfile unchanged since the last sync.")
+            return False
+
+        step.wip("Lockfile changed since the last sync, let's sync the packages.")
+        if os.path.basename(lockfile) == "Pipfile.lock":
+            # Pipenv uses the activated virtualenv, i.e. the one of $VIRTUAL_ENV
+            sync_cmd = [
+                "sudo",
+                "-u",
+                LINUX_USER_DJANGO_USERNAME,
+                "-H",
+                "env",
+                f"VIRTUAL_ENV={venv_dir}",
+                f"PIP_CACHE_DIR={DJANGO_APP_PIP_CACHE_DIR}",
+                "PIPENV_VERBOSITY=-1",
+                "/usr/local/bin/pipenv",
+                "sync",
+            ]
+        else:
+            # A "requirements.txt" is a lockfile only when it pins each package hash
+            sync_cmd = [*pip, "install", "--require-hashes", "-r", lockfile]
+        _run_network(sync_cmd, cwd=app_dir)
+        create_file(synced_lockfile_hash_path, lockfile_hash)
+        step.done("App packages synced.")
+        return True
+
+
+def python_compileall_cmd(
+    python_bin: str, path: str, exclude_regex: t.Optional[str] = None
+) -> t.List[str]:
+    optimization_flags = (
+        ["-" + "O" * PASSENGER_PYTHON_OPTIMIZATION_LEVEL]
+        if PASSENGER_PYTHON_OPTIMIZATION_LEVEL
+        else []
+    )
+    exclude_flags = ["-x", exclude_regex] if exclude_regex else []
+    # "compileall" only recompiles the modules whose source changed, so it's cheap to re-run
+    return [
+        python_bin,
+        *optimization_flags,
+        "-m",
+        "compileall",
+        *exclude_flags,
+        path,
+    ]
+
+
+def python_compiled_modules_count(process_result: "RunResult") -> int:
+    # Without "-q", compileall prints a "Compiling '...'..." line for each module it compiles
+    return sum(
+        1
+        for line in (process_result.stdout or "").splitlines()
+        if line.startswith("Compiling ")
+    )
+
+
+def python_chown_bytecode(path: str) -> None:
+    chown_cmd = f"""\
+find '{path}/' -type d -name __pycache__ \
+-exec chown -R '{LINUX_USER_DJANGO_USERNAME}:{LINUX_USER_DJANGO_GROUPNAME}' {{}} +
+"""
+    _run(chown_cmd, shell=True)
+
+
+def python_compile_site_packages(python_bin: str) -> None:
+    with _step(f"Compiling '{python_bin}' site-packages bytecode...") as step:
+        get_site_packages_cmd = [
+            python_bin,
+            "-c",
+            "import site; print('\\n'.join(site.getsitepackages()))",
+        ]
+        process_result = _run(get_site_packages_cmd)
+        site_packages_dirs = [
+            path
+            for path in (process_result.stdout or "").splitlines()
+            if _executor.is_dir(path)
+        ]
+        compiled_count = 0
+        for site_packages_dir in site_packages_dirs:
+            # Without that Passenger workers would compile these modules on every spawn
+            compile_result = _run(
+                python_compileall_cmd(python_bin, site_packages_dir),
+                panic_on_error=False,
+            )
+            compiled_count += python_compiled_modules_count(compile_result)
+            python_chown_bytecode(site_packages_dir)
+        if not compiled_count:
+            step.nothing_to_do("Bytecode already up to date.")
+            return
+        step.done(
+            f"Bytecode compiled ({compiled_count} modules, {len(site_packages_dirs)} site-packages)."
+        )
+
+
+def python_sources_hash(app_dir: str) -> str:
+    # (without our own Passenger entry point, which is written after the bytecode step)
+    cmd = f"""\
+cd '{app_dir}' && \
+find . \\( -path './node_modules' -o -path './.git' -o -path './passenger_wsgi.py' -o -name __pycache__ \\) -prune -o -type f -name '*.py' -print0 \
+| sort -z | xargs -0 sha256sum | sha256sum | cut -d ' ' -f 1
+"""
+    process_result = _run(cmd, shell=True)
+    return (process_result.stdout or "").strip()
+
+
+def python_bytecode_compiled(app_dir: str, venv_dir: str) -> bool:
+    """Whether the bytecode of the current app sources was compiled, without compiling it"""
+    return check_file_content(
+        f"{venv_dir}/{_PYTHON_COMPILED_SOURCES_HASH_FILE_NAME}",
+        python_sources_hash(app_dir),
+    )
+
+
+def python_compile_app(app_dir: str) -> None:
+    with _step(f"Compiling the Django app bytecode in '{app_dir}'...") as step:
+        # (trailing slash: the app folder is likely to be a symlink)
+        # We skip the same folders than `python_sources_hash()`: "node_modules" notably
+        # ships Python 2 files (gyp) which can't be compiled.
+        compile_result = _run(
+            python_compileall_cmd(
+                f"{DJANGO_APP_VENV_DIR}/bin/python",
+                f"{app_dir}/",
+                exclude_regex=r"/(node_modules|\.git|__pycache__)/",
+            )
+        )
+        python_chown_bytecode(app_dir)
+        compiled_count = python_compiled_modules_count(compile_result)
+        if not compiled_count:
+            step.nothing_to_do("Bytecode already up to date.")
+            return
+        step.done(f"Bytecode compiled ({compiled_count} modules).")
+
+
+def python_report_import_times(
+    app_dir: str, app_project_name: str, top: int = 20
+) -> None:
+    with _step(
+        f"Measuring the import times of the '{app_project_name}.wsgi' entry point..."
+    ) as step:
+        cmd = [
+            "sudo",
+            "-u",
+            LINUX_USER_DJANGO_USERNAME,
+            f"{DJANGO_APP_VENV_DIR}/bin/python",
+            "-X",
+            "importtime",
+            "-c",
+            f"import {app_project_name}.wsgi",
+        ]
+        process_result = _run(cmd, cwd=app_dir)
+        # Each line looks like "import time:       152 |       2451 | django.conf"
+        import_times: t.List[t.Tuple[int, int, str]] = []
+        for line in (process_result.stderr or "").splitlines():
+            match = re.match(r"^import time:\s+(\d+) \|\s+(\d+) \| (.+)$", line)
+            if match:
+                import_times.append(
+                    (int(match.group(2)), int(match.group(1)), match.group(3).strip())
+                )
+        import_times.sort(reverse=True)
+        for cumulative_us, self_us, module in import_times[:top]:
+            step.wip(
+                f"{cumulative_us / 1000:8.1f} ms (self: {self_us / 1000:6.1f} ms)  {module}"
+            )
+        step.checked(
+            f"{len(import_times)} modules imported, top {min(top, len(import_times))} by cumulative import time above."
+        )
+
+
+def monitoring_setup_exporter(
+    service_name: str, defaults_file_content: str, port: str
+) -> None:
+    # (exporters can't reload their command line flags)
+    create_file_if_needed(
+        f"/etc/default/{service_name}",
+        defaults_file_content,
+        notify=[service_name],
+        restart=True,
+    )
+    # It only listens on localhost, but let's make sure the firewall would block it anyway
+    firewall_rule_deny_if_needed(port)
+
+
+def postgres_monitoring_setup() -> None:
+    create_file_if_needed(
+        f"{_POSTGRES_CONF_DIR}/monitoring.conf",
+        _postgres_monitoring_conf_file(),
+        owner="postgres:postgres",
+        notify=["postgresql"],
+    )
+
+    # The exporter runs as the "prometheus" Linux user, and connects to Postgres
+    # through the Unix socket with the matching Postgres role ("peer" authentication).
+    prometheus_role_exists = partial(db_user_exists, "prometheus")
+    with _step("Checking database user 'prometheus' status...") as step:
+        if prometheus_role_exists():
+            step.nothing_to_do("Database user exists.")
+        else:
+            _run_sql("create user prometheus; grant pg_monitor to prometheus;")
+            if not prometheus_role_exists():
+                _panic("Could not create user")
+            step.done("Database user created.")
+
+
+def frontend_sources_hash(app_dir: str) -> str:
+    # Everything but the Python files and the folders that are generated:
+    # a change in the Django templates may well change the assets (CSS purge, etc.)
+    pruned_paths = " -o ".join(
+        f"-path './{path}'"
+        for path in ("node_modules", ".git", FRONTEND_BUILD_DIR, "static")
+    )
+    cmd = f"""\
+cd '{app_dir}' && \
+find . \\( {pruned_paths} -o -name __pycache__ \\) -prune -o -type f ! -name '*.py' -print0 \
+| sort -z | xargs -0 sha256sum | sha256sum | cut -d ' ' -f 1
+"""
+    process_result = _run(cmd, shell=True)
+    return (process_result.stdout or "").strip()
+
+
+def frontend_yarn_cmd(*args: str) -> t.List[str]:
+    # The Yarn cache is shared between the app releases, so most packages never get downloaded again
+    return [
+        "sudo",
+        "-u",
+        LINUX_USER_DJANGO_USERNAME,
+        "-H",
+        "env",
+        f"YARN_CACHE_FOLDER={DJANGO_APP_YARN_CACHE_DIR}",
+        "yarn",
+        *args,
+    ]
+
+
+def frontend_yarn_install_if_needed(app_dir: str) -> bool:
+    with _step(f"Checking the frontend packages of '{app_dir}'...") as step:
+        lockfile_hash = hashlib.sha256(
+            _executor.read_bytes(f"{app_dir}/yarn.lock")
+        ).hexdigest()
+        installed_lockfile_hash_path = f"{app_dir}/node_modules/.yarn-lock.sha256"
+        if check_file_content(installed_lockfile_hash_path, lockfile_hash):
+            step.nothing_to_do("'yarn.lock' unchanged since the last install.")
+            return False
+        cmd = frontend_yarn_cmd(
+            "install", "--frozen-lockfile", "--prefer-offline", "--non-interactive"
+        )
+        _run_network(cmd, cwd=app_dir)
+        create_file(installed_lockfile_hash_path, lockfile_hash)
+        step.done("Frontend packages installed.")
+        return True
+
+
+def frontend_build_and_publish(app_dir: str, static_dir: str) -> None:
+    with _step(f"Building the frontend assets of '{app_dir}'...") as step:
+        _run(frontend_yarn_cmd("build"), cwd=app_dir)
+        step.wip(f"Publishing them to '{static_dir}'...")
+        as_django_user = ["sudo", "-u", LINUX_USER_DJANGO_USERNAME]
+        _run([*as_django_user, "mkdir", "-p", static_dir])
+        _run(
+            [
+                *as_django_user,
+                "cp",
+                "-a",
+                f"{app_dir}/{FRONTEND_BUILD_DIR}/.",
+                f"{static_dir}/",
+            ]
+        )
+        step.wip("Pre-compressing them for Nginx...")
+        name_filters = " -o ".join(
+            f"-name '*.{extension}'" for extension in _FRONTEND_COMPRESSED_EXTENSIONS
+        )
+        compress_cmd = f"""\
+sudo -u '{LINUX_USER_DJANGO_USERNAME}' find '{static_dir}' -type f \\( {name_filters} \\) \
+-exec gzip -k -f -9 {{}} + -exec brotli -k -f -q 11 {{}} +
+"""
+        _run(compress_cmd, shell=True)
+        step.done("Frontend assets built and published.")
+
+
+def frontend_has_assets(app_dir: str) -> bool:
+    return _executor.is_file(f"{app_dir}/package.json") and _executor.is_file(
+        f"{app_dir}/yarn.lock"
+    )
+
+
+def frontend_assets_published(app_dir: str, static_dir: str) -> bool:
+    """Whether the assets of the current sources were published, without building them"""
+    if not frontend_has_assets(app_dir):
+        return True
+    # (the sources hash covers the "yarn.lock" too)
+    return check_file_content(
+        f"{static_dir}/{_FRONTEND_PUBLISHED_SOURCES_HASH_FILE_NAME}",
+        frontend_sources_hash(app_dir),
+    )
+
+
+def frontend_build_assets_if_needed(app_dir: str, static_dir: str) -> bool:
+    with _step(f"Checking the frontend assets of '{app_dir}'...") as step:
+        if not frontend_has_assets(app_dir):
+            step.nothing_to_do("No 'package.json' and 'yarn.lock': no assets to build.")
+            return False
+        sources_hash = frontend_sources_hash(app_dir)
+        published_sources_hash_path = (
+            f"{static_dir}/{_FRONTEND_PUBLISHED_SOURCES_HASH_FILE_NAME}"
+        )
+        if check_file_content(published_sources_hash_path, sources_hash):
+            step.nothing_to_do("Sources unchanged since the last build.")
+            return False
+
+        step.wip("Sources changed since the last build, let's build the assets.")
+        install_debian_package_if_needed("brotli")
+        frontend_yarn_install_if_needed(app_dir)
+        frontend_build_and_publish(app_dir, static_dir)
+        create_file(published_sources_hash_path, sources_hash)
+        step.done("Frontend assets up to date.")
+        return True
+
+
+def postgres_report(db_name: str) -> None:
+    with _step(f"Reporting on database '{db_name}'...") as step:
+        for title, sql in (
+            ("Top queries by total time", _POSTGRES_REPORT_TOP_QUERIES_SQL),
+            ("Table bloat estimates", _POSTGRES_REPORT_TABLE_BLOAT_SQL),
+            ("Index usage and hit ratios", _POSTGRES_REPORT_INDEX_HIT_SQL),
+        ):
+            step.wip(f"{title}:")
+            for line in (_run_sql(sql, db_name=db_name) or "").splitlines():
+                step.wip(f"  {line}")
+        step.checked("Report done.")
+
+
+def postgres_ensure_extension(extension: str, db_name: str) -> bool:
+    extension_exists = partial(db_extension_exists, extension, db_name)
+    with _step(f"Checking extension '{extension}' in database '{db_name}'...") as step:
+        if extension_exists():
+            step.nothing_to_do("Extension exists.")
+            return False
+        _run_sql(f"create extension {extension};", db_name=db_name)
+        if not extension_exists():
+            _panic("Could not create extension")
+        step.done("Extension created.")
+        return True
+
+
 def postgres_django_setup_ensure_db(db_name: str) -> bool:
     db_exists = partial(db_database_exists, db_name)
     with _step(f"Checking database '{db_name}' status...") as step:
@@ -743,18 +1775,91 @@ commit;
 
 def nginx_activate_nginx_site_if_needed(
     available_sites_path: str, enabled_sites_path: str, site_name: str, site_config: str
-) -> None:
-    nginx_disable_site_if_needed("default")
+) -> bool:
+    default_site_disabled = nginx_disable_site_if_needed("default")
 
     nginx_site_target_file = f"{enabled_sites_path}/{site_name}"
     with _step(f"Checking nginx enabled symlink '{nginx_site_target_file}'...") as step:
         nginx_site_target_ok = check_file_content(nginx_site_target_file, site_config)
         if nginx_site_target_ok:
             step.nothing_to_do("Nginx site already enabled.")
-        else:
-            nginx_enable_site(available_sites_path, enabled_sites_path, site_name)
-            nginx_check_config_or_die()
-            step.done("Nginx site enabled.")
+            return default_site_disabled
+        nginx_enable_site(available_sites_path, enabled_sites_path, site_name)
+        nginx_check_config_or_die()
+        step.done("Nginx site enabled.")
+        return True
+
+
+def nginx_create_self_signed_certificate_if_needed(
+    certificate_path: str, key_path: str
+) -> bool:
+    with _step(f"Checking self-signed TLS certificate '{certificate_path}'...") as step:
+        if _executor.is_file(certificate_path) and _executor.is_file(key_path):
+            step.nothing_to_do("Certificate already created.")
+            return False
+        _executor.makedirs(os.path.dirname(certificate_path))
+        _executor.makedirs(os.path.dirname(key_path))
+        cmd = [
+            "openssl",
+            "req",
+            "-x509",
+            "-nodes",
+            "-newkey",
+            "rsa:2048",
+            "-days",
+            "365",
+            "-subj",
+            f"/CN={NGINX_SERVER_NAME or 'localhost'}",
+            "-keyout",
+            key_path,
+            "-out",
+            certificate_path,
+        ]
+        _run(cmd)
+        _executor.chmod(key_path, 0o600)
+        managed_files_notify(["nginx"])
+        step.done("Self-signed certificate created.")
+        return True
+
+
+def nginx_microcache_zone_sizes(cache_path: str) -> t.Tuple[int, int]:
+    """
+    Returns the (keys zone size, max cache size) of the Nginx micro-cache, in MB.
+    One megabyte of keys zone stores about 8000 keys: we give it 1/512 of the RAM,
+    while the cached responses themselves can use up to 10% of the free disk space.
+    The latter is rounded down to a power of two: the free disk space changes all the
+    time, but the site config (and thus Nginx) should only change when it really shrinks
+    or grows.
+    """
+    memory_total_mb = read_meminfo().get("MemTotal", 0) // 1024
+    keys_zone_size = min(max(memory_total_mb // 512, 1), 64)
+    disk_free_mb = _executor.disk_free_bytes(cache_path) // (1024 * 1024)
+    max_size_power_of_two = 1 << max((disk_free_mb // 10).bit_length() - 1, 0)
+    max_size = min(max(max_size_power_of_two, 64), 1024)
+    return keys_zone_size, max_size
+
+
+def nginx_microcache_ensure_dir(cache_path: str) -> bool:
+    with _step(f"Checking Nginx micro-cache folder '{cache_path}'...") as step:
+        if _executor.is_dir(cache_path):
+            step.nothing_to_do("Micro-cache folder exists.")
+            return False
+        _executor.makedirs(cache_path)
+        _run(["chown", "www-data:www-data", cache_path])
+        step.done("Micro-cache folder created.")
+        return True
+
+
+def nginx_purge_microcache(cache_path: str) -> None:
+    # The open source version of Nginx has no "proxy_cache_purge" directive,
+    # but wiping the cache files is safe: Nginx just sees them as cache misses.
+    with _step(f"Purging Nginx micro-cache '{cache_path}'...") as step:
+        if not _executor.is_dir(cache_path):
+            step.nothing_to_do("No micro-cache folder, nothing to purge.")
+            return
+        cmd = ["find", cache_path, "-type", "f", "-delete"]
+        _run(cmd)
+        step.done("Micro-cache purged.")
 
 
 def create_blank_django_app_if_needed(app_dir: str, app_project_name: str) -> bool:
@@ -762,7 +1867,7 @@ def create_blank_django_app_if_needed(app_dir: str, app_project_name: str) -> bo
         f"Checking if we have a Django app in the '{app_dir}' folder (project '{app_project_name}')..."
     ) as step:
         django_settings_file_path = f"{app_dir}/{app_project_name}/wsgi.py"
-        if Path(app_dir).is_dir() and Path(django_settings_file_path).is_file():
+        if _executor.is_dir(app_dir) and _executor.is_file(django_settings_file_path):
             step.nothing_to_do("Django app found.")
             return False
         step.wip("Django app not found! Let's create a blank one for the moment.")
@@ -776,12 +1881,14 @@ def create_blank_django_app(app_dir: str, app_project_name: str) -> None:
         f"Creating a blank Django project '{app_project_name}' in {app_dir}..."
     ) as step:
 
-        install_python_package_if_needed("django")
+        install_python_package_if_needed(
+            "django", pip=python_venv_pip_cmd(DJANGO_APP_VENV_DIR)
+        )
 
-        os.makedirs(app_dir, exist_ok=True)
+        _executor.makedirs(app_dir)
         create_project_cmd = [
-            f"python{TARGET_PYTHON_VERSION}",
-            "/usr/local/bin/django-admin",
+            f"{DJANGO_APP_VENV_DIR}/bin/python",
+            f"{DJANGO_APP_VENV_DIR}/bin/django-admin",
             "startproject",
             app_project_name,
             app_dir,
@@ -796,21 +1903,89 @@ def create_blank_django_app(app_dir: str, app_project_name: str) -> None:
         ]
         _run(chown_cmd)
 
-        with _step(
-            "Adding the server IP address to Django's ALLOWED_HOSTS..."
-        ) as django_hosts_step:
-            update_django_allowed_hosts_cmd = f"""\
-sed -i -r \
-"s~^ALLOWED_HOSTS = .+$~ALLOWED_HOSTS = ['$(hostname -I | cut -d ' ' -f 1)']~" \
-{app_dir}/{app_project_name}/settings.py    
-"""
-            _run(update_django_allowed_hosts_cmd, shell=True)
-            django_hosts_step.done("Django ALLOWED_HOSTS updated.")
-
         step.done("Blank Django project created.")
         _report(r"/!\ Beware! This app is in DEBUG mode at the moment.")
 
 
+_DJANGO_BLANK_ALLOWED_HOSTS = re.compile(r"^ALLOWED_HOSTS = \[\]$", flags=re.M)
+
+
+def django_has_blank_allowed_hosts(app_dir: str, app_project_name: str) -> bool:
+    # Only our blank app still has the empty ALLOWED_HOSTS of `django-admin startproject`:
+    # we never touch the settings of a real app.
+    try:
+        settings = _executor.read_text(f"{app_dir}/{app_project_name}/settings.py")
+    except FileNotFoundError:
+        return False
+    return _DJANGO_BLANK_ALLOWED_HOSTS.search(settings) is not None
+
+
+def django_set_allowed_hosts_if_needed(app_dir: str, app_project_name: str) -> bool:
+    if not django_has_blank_allowed_hosts(app_dir, app_project_name):
+        return False
+
+    settings_path = f"{app_dir}/{app_project_name}/settings.py"
+    with _step("Adding the server IP address to Django's ALLOWED_HOSTS...") as step:
+        process_result = _run(["hostname", "-I"])
+        server_ips = (process_result.stdout or "").split()
+        if not server_ips:
+            _panic(
+                "The server has no IP address yet (`hostname -I` printed nothing): is its network up?"
+            )
+        server_ip = server_ips[0]
+        create_file(
+            settings_path,
+            _DJANGO_BLANK_ALLOWED_HOSTS.sub(
+                f"ALLOWED_HOSTS = ['{server_ip}']", _executor.read_text(settings_path)
+            ),
+            owner=f"{LINUX_USER_DJANGO_USERNAME}:{LINUX_USER_DJANGO_GROUPNAME}",
+        )
+        managed_files_notify(["nginx"])
+        step.done(f"Django ALLOWED_HOSTS updated ('{server_ip}').")
+        return True
+
+
+def setup_checkpoints_read() -> t.List[str]:
+    try:
+        checkpoints = json.loads(_executor.read_text(SETUP_CHECKPOINTS_PATH))
+    except (FileNotFoundError, ValueError):
+        return []
+    return checkpoints.get("completed_steps", [])
+
+
+def setup_checkpoints_write(completed_steps: t.List[str]) -> None:
+    _executor.makedirs(os.path.dirname(SETUP_CHECKPOINTS_PATH))
+    checkpoints = {"completed_steps": completed_steps}
+    _executor.write_text(SETUP_CHECKPOINTS_PATH, json.dumps(checkpoints, indent=2))
+
+
+def image_clean_caches() -> None:
+    with _step("Cleaning the caches before the image snapshot...") as step:
+        _run(["apt-get", "clean"])
+        cache_dirs = [
+            "/root/.cache/pip",
+            DJANGO_APP_PIP_CACHE_DIR,
+            DJANGO_APP_YARN_CACHE_DIR,
+        ]
+        _run(["rm", "-rf", *cache_dirs])
+        # Each server booted from the image will then generate its own machine ID
+        _run(["truncate", "-s", "0", "/etc/machine-id"])
+        step.done("Caches cleaned.")
+
+
+def image_mark_as_baked(mark_path: str) -> None:
+    with _step(f"Marking the image as baked, in '{mark_path}'...") as step:
+        mark = {
+            "baked_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": TARGET_PYTHON_VERSION,
+            "nodejs": TARGET_NODEJS_VERSION,
+            "postgres": TARGET_POSTGRES_VERSION,
+        }
+        _executor.makedirs(os.path.dirname(mark_path))
+        _executor.write_text(mark_path, json.dumps(mark, indent=2) + "\n")
+        step.done("Image marked as baked.")
+
+
 ##################
 # Low level functions
 ##################
@@ -851,20 +2026,402 @@ class SubProcessError(RuntimeError):
         return f"{self.__class__.__name__}({self.cmd}, '${self.process_result}')"
 
 
+def _cmd_line(cmd: Cmd) -> str:
+    return cmd if isinstance(cmd, str) else " ".join(str(arg) for arg in cmd)
+
+
+def _cmd_program_name(cmd: Cmd) -> str:
+    # "sudo -u postgres psql -c ..." -> "psql", "(APT_KEY_DONT_WARN_ON_DANGEROUS_USAGE=1 apt-key list..." -> "apt-key"
+    words = _cmd_line(cmd).lstrip("(").split()
+    while words and (words[0] in ("sudo", "env", "-H") or "=" in words[0]):
+        words = words[3:] if words[0] == "sudo" else words[1:]
+    return os.path.basename(words[0]) if words else ""
+
+
+class CommandExecutor(abc.ABC):
+    """
+    Everything that reads or changes the state of the server goes through an executor:
+    the subprocesses we spawn, as well as the few files we read and write ourselves.
+    """
+
+    @abc.abstractmethod
+    def run(self, cmd: Cmd, **kwargs) -> subprocess.CompletedProcess:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read_text(self, path: str) -> str:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read_bytes(self, path: str) -> bytes:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def write_text(self, path: str, content: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def is_file(self, path: str) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def is_dir(self, path: str) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def is_symlink(self, path: str) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def realpath(self, path: str) -> str:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def makedirs(self, path: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def disk_free_bytes(self, path: str) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def geteuid(self) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def stat(self, path: str) -> t.Optional[t.Tuple[int, int]]:
+        """Returns the (size, mtime in ns) of a file, following symlinks - or None if it doesn't exist"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def chown(self, path: str, owner: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def chmod(self, path: str, mode: int) -> None:
+        raise NotImplementedError
+
+
+class SystemExecutor(CommandExecutor):
+    def run(self, cmd: Cmd, **kwargs) -> subprocess.CompletedProcess:
+        # pylint: disable=E1120
+        # (@link https://github.com/PyCQA/pylint/issues/1898)
+        return subprocess.run(cmd, **kwargs)
+
+    def read_text(self, path: str) -> str:
+        with open(path, mode="r") as f:
+            return f.read()
+
+    def read_bytes(self, path: str) -> bytes:
+        with open(path, mode="rb") as f:
+            return f.read()
+
+    def write_text(self, path: str, content: str) -> None:
+        # Written in a temporary file which then replaces the target one:
+        # a crash in the middle of the write can't leave a truncated config file behind.
+        path = os.path.realpath(path)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            current_stat = os.stat(path)
+            os.chmod(tmp_path, current_stat.st_mode & 0o7777)
+            os.chown(tmp_path, current_stat.st_uid, current_stat.st_gid)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+        dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def is_file(self, path: str) -> bool:
+        return os.path.isfile(path)
+
+    def is_dir(self, path: str) -> bool:
+        return os.path.isdir(path)
+
+    def is_symlink(self, path: str) -> bool:
+        return os.path.islink(path)
+
+    def realpath(self, path: str) -> str:
+        return os.path.realpath(path)
+
+    def makedirs(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+
+    def disk_free_bytes(self, path: str) -> int:
+        # The target path may not exist yet: let's check its closest existing parent
+        existing_path = os.path.abspath(path)
+        while not os.path.exists(existing_path) and existing_path != "/":
+            existing_path = os.path.dirname(existing_path)
+        return shutil.disk_usage(existing_path).free
+
+    def geteuid(self) -> int:
+        return os.geteuid()
+
+    def stat(self, path: str) -> t.Optional[t.Tuple[int, int]]:
+        try:
+            file_stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    def chown(self, path: str, owner: str) -> None:
+        user, _, group = owner.partition(":")
+        shutil.chown(path, user, group or None)
+
+    def chmod(self, path: str, mode: int) -> None:
+        os.chmod(path, mode)
+
+
+def _mask_secrets(args: t.List[t.Any]) -> t.List[t.Any]:
+    # We don't want to write the Postgres password in the recordings
+    def mask(value: t.Any) -> t.Any:
+        if isinstance(value, list):
+            return [mask(item) for item in value]
+        if isinstance(value, str):
+            return re.sub(r"(password ')[^']*(')", r"\1***\2", value)
+        return value
+
+    return [mask(arg) for arg in args]
+
+
+def _serialize_executor_result(method: str, result: t.Any) -> t.Any:
+    if method == "run":
+        return {
+            "returncode": result.returncode,
+            "stdout": result.stdout.decode("utf-8") if result.stdout else None,
+            "stderr": result.stderr.decode("utf-8") if result.stderr else None,
+        }
+    if method == "read_bytes":
+        return base64.b64encode(result).decode("ascii")
+    return result
+
+
+class ForwardingExecutor(CommandExecutor):
+    """An executor which forwards each of its calls to its `_call()` method"""
+
+    @abc.abstractmethod
+    def _call(self, method: str, *args, **kwargs) -> t.Any:
+        raise NotImplementedError
+
+    def run(self, cmd: Cmd, **kwargs) -> subprocess.CompletedProcess:
+        return self._call("run", cmd, **kwargs)
+
+    def read_text(self, path: str) -> str:
+        return self._call("read_text", path)
+
+    def read_bytes(self, path: str) -> bytes:
+        return self._call("read_bytes", path)
+
+    def write_text(self, path: str, content: str) -> None:
+        self._call("write_text", path, content)
+
+    def is_file(self, path: str) -> bool:
+        return self._call("is_file", path)
+
+    def is_dir(self, path: str) -> bool:
+        return self._call("is_dir", path)
+
+    def is_symlink(self, path: str) -> bool:
+        return self._call("is_symlink", path)
+
+    def realpath(self, path: str) -> str:
+        return self._call("realpath", path)
+
+    def makedirs(self, path: str) -> None:
+        self._call("makedirs", path)
+
+    def disk_free_bytes(self, path: str) -> int:
+        return self._call("disk_free_bytes", path)
+
+    def geteuid(self) -> int:
+        return self._call("geteuid")
+
+    def stat(self, path: str) -> t.Optional[t.Tuple[int, int]]:
+        return self._call("stat", path)
+
+    def chown(self, path: str, owner: str) -> None:
+        self._call("chown", path, owner)
+
+    def chmod(self, path: str, mode: int) -> None:
+        self._call("chmod", path, mode)
+
+
+class RecordingExecutor(ForwardingExecutor):
+    """
+    Records every call made to another executor, as newline-delimited JSON,
+    so that a real run can later be replayed offline by a `ReplayingExecutor`.
+    """
+
+    def __init__(self, executor: CommandExecutor, path: str) -> None:
+        self._executor = executor
+        self._file = open(path, mode="w", buffering=1, encoding="utf-8")
+
+    def _call(self, method: str, *args, **kwargs) -> t.Any:
+        record: t.Dict[str, t.Any] = {
+            "method": method,
+            "args": _mask_secrets(list(args)),
+        }
+        started_at = time.monotonic()
+        try:
+            result = getattr(self._executor, method)(*args, **kwargs)
+            record["result"] = _serialize_executor_result(method, result)
+            return result
+        except FileNotFoundError:
+            record["error"] = "FileNotFoundError"
+            raise
+        finally:
+            record["duration"] = round(time.monotonic() - started_at, 6)
+            self._file.write(json.dumps(record) + "\n")
+
+
+_executor: CommandExecutor = SystemExecutor()
+
+
+class ManagedFilesState:
+    """
+    What we know about the files we manage - their content hash, size and mtime when we last
+    wrote or checked them - and the services they notified that still wait for their reload
+    (or restart), as well as a pending Systemd "daemon-reload" when unit files changed.
+    It's persisted as JSON, so that a file that didn't change since the previous run
+    doesn't even have to be read, and a reload is not lost if a run crashes before it.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._loaded_for: t.Optional[CommandExecutor] = None
+        self._files: t.Dict[str, t.Dict[str, t.Any]] = {}
+        # ("[service name, 'reload' or 'restart']" pairs, in notification order)
+        self._notifications: t.List[t.List[str]] = []
+        self._daemon_reload = False
+
+    def is_unchanged(
+        self, file_path: str, content_hash: str, file_stat: t.Tuple[int, int]
+    ) -> bool:
+        self._load_if_needed()
+        file_state = self._files.get(file_path)
+        return file_state is not None and (
+            file_state["sha256"],
+            file_state["size"],
+            file_state["mtime_ns"],
+        ) == (content_hash, *file_stat)
+
+    def record(
+        self, file_path: str, content_hash: str, file_stat: t.Tuple[int, int]
+    ) -> None:
+        self._load_if_needed()
+        size, mtime_ns = file_stat
+        self._files[file_path] = {
+            "sha256": content_hash,
+            "size": size,
+            "mtime_ns": mtime_ns,
+        }
+        self._save()
+
+    def notify(self, service_name: str, restart: bool = False) -> None:
+        self._load_if_needed()
+        action = "restart" if restart else "reload"
+        for notification in self._notifications:
+            if notification[0] == service_name:
+                # A restart also applies what a reload would have
+                if restart and notification[1] != action:
+                    notification[1] = action
+                    self._save()
+                return
+        self._notifications.append([service_name, action])
+        self._save()
+
+    def pending_notifications(self) -> t.List[t.Tuple[str, bool]]:
+        self._load_if_needed()
+        return [(name, action == "restart") for name, action in self._notifications]
+
+    def notification_done(self, service_name: str) -> None:
+        self._load_if_needed()
+        self._notifications = [
+            notification
+            for notification in self._notifications
+            if notification[0] != service_name
+        ]
+        self._save()
+
+    def notify_daemon_reload(self) -> None:
+        self._load_if_needed()
+        self._daemon_reload = True
+        self._save()
+
+    def daemon_reload_pending(self) -> bool:
+        self._load_if_needed()
+        return self._daemon_reload
+
+    def daemon_reload_done(self) -> None:
+        self._load_if_needed()
+        self._daemon_reload = False
+        self._save()
+
+    def _load_if_needed(self) -> None:
+        # The state belongs to the system we work on: a different executor means a different one
+        if self._loaded_for is _executor:
+            return
+        self._loaded_for = _executor
+        try:
+            state = json.loads(_executor.read_text(self.path))
+        except (FileNotFoundError, ValueError):
+            state = {}
+        self._files = state.get("files", {})
+        # (the state files written before reloads existed only list the services
+        # names: these services were waiting for a restart)
+        self._notifications = [
+            [notification, "restart"]
+            if isinstance(notification, str)
+            else list(notification)
+            for notification in state.get("pending_notifications", [])
+        ]
+        self._daemon_reload = state.get("pending_daemon_reload", False)
+
+    def _save(self) -> None:
+        _executor.makedirs(os.path.dirname(self.path))
+        state = {
+            "files": self._files,
+            "pending_notifications": self._notifications,
+            "pending_daemon_reload": self._daemon_reload,
+        }
+        _executor.write_text(self.path, json.dumps(state, indent=2, sort_keys=True))
+
+
+_managed_files = ManagedFilesState(MANAGED_FILES_STATE_PATH)
+
+
+@contextmanager
+def _using_executor(executor: CommandExecutor) -> t.Generator[None, None, None]:
+    global _executor  # pylint: disable=global-statement
+    previous_executor = _executor
+    _executor = executor
+    try:
+        yield
+    finally:
+        _executor = previous_executor
+
+
 def _run(
     cmd: Cmd, panic_on_error: bool = True, capture_output=True, **kwargs
 ) -> RunResult:
-    # pylint: disable=E1120
-    # (@link https://github.com/PyCQA/pylint/issues/1898)
-
     # No "capture_output" param in Python < 3.7, so we have to deal with "stdout" & "stderr" manually :-/
     if capture_output is True and kwargs.get("stdout") is None:
         kwargs["stdout"] = subprocess.PIPE
     if capture_output is True and kwargs.get("stderr") is None:
         kwargs["stderr"] = subprocess.PIPE
 
+    started_at = time.monotonic()
     try:
-        process_result = subprocess.run(cmd, **kwargs)
+        process_result = _executor.run(cmd, **kwargs)
+        _reporter.subprocess_done(
+            cmd, process_result.returncode, time.monotonic() - started_at
+        )
         success = process_result.returncode == 0
 
         stdout = (
@@ -879,13 +2436,36 @@ def _run(
             raise SubProcessError(cmd, result)
 
     except FileNotFoundError as e:
+        _reporter.subprocess_done(cmd, None, time.monotonic() - started_at)
         result = RunResult(success=False, error=e)
 
     return result
 
 
-def _run_sql(sql: str) -> t.Optional[str]:
+def _run_network(cmd: Cmd, **kwargs) -> RunResult:
+    """
+    Runs a command which downloads things, retrying it with an exponential backoff
+    (2s, 4s, 8s...) when it fails: flaky networks and busy mirrors are common.
+    """
+    attempt = 0
+    while True:
+        try:
+            return _run(cmd, **kwargs)
+        except SubProcessError:
+            if attempt >= NETWORK_RETRIES:
+                raise
+            delay = _NETWORK_RETRY_BASE_DELAY_SECONDS * 2 ** attempt
+            attempt += 1
+            _report(
+                f"Command failed, retrying it in {delay}s ({attempt}/{NETWORK_RETRIES})..."
+            )
+            time.sleep(delay)
+
+
+def _run_sql(sql: str, db_name: t.Optional[str] = None) -> t.Optional[str]:
     cmd = ["sudo", "-u", "postgres", "psql", "-v", "ON_ERROR_STOP=1", "-c", sql]
+    if db_name:
+        cmd += ["-d", db_name]
     process_result = _run(cmd)
     return process_result.stdout
 
@@ -903,31 +2483,273 @@ def _check_cmd_output(cmd: Cmd, pattern: str, shell: bool = False) -> bool:
     return process_result.stdout_matches(pattern)
 
 
-def _report(
-    *args,
-    step_start: bool = False,
-    step_wip: bool = False,
-    step_done: bool = False,
-    fatal: bool = False,
-) -> None:
-    # pylint: disable=protected-access
-    if fatal:
-        prefix = " 💀 "
-    else:
-        prefix = "."
-        if step_start:
-            prefix = "┌"
-        elif step_wip:
-            prefix = "│"
-        elif step_done:
-            prefix = "└"
-            _report._report_nb_levels -= 1  # type: ignore
-        prefix = " " + ("  " * _report._report_nb_levels) + prefix  # type: ignore
-
-    print(prefix, *args)
-
-    if step_start and not fatal:
-        _report._report_nb_levels += 1  # type: ignore
+class ReportStep:
+    def __init__(self, caption: str, ensured_name: t.Optional[str] = None) -> None:
+        self.caption = caption
+        # Only "Ensuring" steps have a name, e.g. "Postgres"
+        self.ensured_name = ensured_name
+        self.started_at = time.monotonic()
+        self.changed = False
+
+
+class ReportBackend:
+    """
+    A destination for the progress of a run: the "tree" printed on stdout is one of them,
+    but we can also have machine-readable ones. Every hook is a no-op by default.
+    """
+
+    def step_start(self, step: ReportStep, depth: int) -> None:
+        pass
+
+    def step_wip(self, caption: str, depth: int) -> None:
+        pass
+
+    def step_end(
+        self,
+        step: ReportStep,
+        caption: str,
+        depth: int,
+        changed: bool,
+        duration: float,
+    ) -> None:
+        pass
+
+    def message(self, caption: str, depth: int, fatal: bool) -> None:
+        pass
+
+    def subprocess_done(
+        self, cmd: Cmd, returncode: t.Optional[int], duration: float
+    ) -> None:
+        pass
+
+    def close(self, success: bool) -> None:
+        pass
+
+
+class TreeReportBackend(ReportBackend):
+    def step_start(self, step: ReportStep, depth: int) -> None:
+        print(" " + ("  " * depth) + "┌", step.caption)
+
+    def step_wip(self, caption: str, depth: int) -> None:
+        print(" " + ("  " * depth) + "│", caption)
+
+    def step_end(
+        self,
+        step: ReportStep,
+        caption: str,
+        depth: int,
+        changed: bool,
+        duration: float,
+    ) -> None:
+        print(" " + ("  " * depth) + "└", caption)
+
+    def message(self, caption: str, depth: int, fatal: bool) -> None:
+        if fatal:
+            print(" 💀 ", caption)
+        else:
+            print(" " + ("  " * depth) + ".", caption)
+
+
+class JsonEventsReportBackend(ReportBackend):
+    """Appends one JSON event per line to a file"""
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, mode="a", buffering=1, encoding="utf-8")
+
+    def _write(self, event: str, **data) -> None:
+        self._file.write(json.dumps({"ts": time.time(), "event": event, **data}) + "\n")
+
+    def step_start(self, step: ReportStep, depth: int) -> None:
+        self._write(
+            "step_start", step=step.caption, depth=depth, ensured=step.ensured_name
+        )
+
+    def step_wip(self, caption: str, depth: int) -> None:
+        self._write("step_wip", message=caption, depth=depth)
+
+    def step_end(
+        self,
+        step: ReportStep,
+        caption: str,
+        depth: int,
+        changed: bool,
+        duration: float,
+    ) -> None:
+        self._write(
+            "step_end",
+            step=step.caption,
+            message=caption.strip(),
+            depth=depth,
+            ensured=step.ensured_name,
+            changed=changed,
+            duration=round(duration, 6),
+        )
+
+    def message(self, caption: str, depth: int, fatal: bool) -> None:
+        self._write("fatal" if fatal else "message", message=caption, depth=depth)
+
+    def subprocess_done(
+        self, cmd: Cmd, returncode: t.Optional[int], duration: float
+    ) -> None:
+        self._write(
+            "subprocess",
+            cmd=cmd if isinstance(cmd, str) else [str(arg) for arg in cmd],
+            returncode=returncode,
+            duration=round(duration, 6),
+        )
+
+    def close(self, success: bool) -> None:
+        self._write("run_end", success=success)
+        self._file.close()
+
+
+class PrometheusTextfileReportBackend(ReportBackend):
+    """
+    Writes the metrics of the run for the node_exporter "textfile" collector.
+    @link https://github.com/prometheus/node_exporter#textfile-collector
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._started_at = time.monotonic()
+        # Keyed by "Ensuring" step name:
+        self._durations: t.Dict[str, float] = {}
+        self._changes: t.Dict[t.Tuple[str, bool], int] = {}
+        self._subprocesses_count = 0
+        self._subprocesses_failures_count = 0
+        self._current_ensuring_steps: t.List[str] = []
+
+    def step_start(self, step: ReportStep, depth: int) -> None:
+        if step.ensured_name:
+            self._current_ensuring_steps.append(step.ensured_name)
+
+    def step_end(
+        self,
+        step: ReportStep,
+        caption: str,
+        depth: int,
+        changed: bool,
+        duration: float,
+    ) -> None:
+        if step.ensured_name:
+            self._current_ensuring_steps.pop()
+            self._durations[step.ensured_name] = (
+                self._durations.get(step.ensured_name, 0.0) + duration
+            )
+        elif self._current_ensuring_steps:
+            key = (self._current_ensuring_steps[-1], changed)
+            self._changes[key] = self._changes.get(key, 0) + 1
+
+    def subprocess_done(
+        self, cmd: Cmd, returncode: t.Optional[int], duration: float
+    ) -> None:
+        self._subprocesses_count += 1
+        if returncode != 0:
+            self._subprocesses_failures_count += 1
+
+    def close(self, success: bool) -> None:
+        def label(value: str) -> str:
+            return value.replace("\\", "\\\\").replace('"', '\\"')
+
+        lines = [
+            "# HELP django_setup_step_duration_seconds Duration of each setup step of the last run.",
+            "# TYPE django_setup_step_duration_seconds gauge",
+            *(
+                f'django_setup_step_duration_seconds{{step="{label(step)}"}} {duration:.6f}'
+                for step, duration in self._durations.items()
+            ),
+            "# HELP django_setup_step_changes Number of sub-steps of each setup step of the last run, by outcome.",
+            "# TYPE django_setup_step_changes gauge",
+            *(
+                f'django_setup_step_changes{{step="{label(step)}",changed="{str(changed).lower()}"}} {count}'
+                for (step, changed), count in self._changes.items()
+            ),
+            "# HELP django_setup_subprocesses Number of subprocesses spawned by the last run.",
+            "# TYPE django_setup_subprocesses gauge",
+            f"django_setup_subprocesses {self._subprocesses_count}",
+            "# HELP django_setup_subprocesses_failed Number of subprocesses of the last run which exited with an error.",
+            "# TYPE django_setup_subprocesses_failed gauge",
+            f"django_setup_subprocesses_failed {self._subprocesses_failures_count}",
+            "# HELP django_setup_run_duration_seconds Duration of the last run.",
+            "# TYPE django_setup_run_duration_seconds gauge",
+            f"django_setup_run_duration_seconds {time.monotonic() - self._started_at:.6f}",
+            "# HELP django_setup_run_success Whether the last run succeeded.",
+            "# TYPE django_setup_run_success gauge",
+            f"django_setup_run_success {int(success)}",
+            "# HELP django_setup_run_timestamp_seconds When the last run ended.",
+            "# TYPE django_setup_run_timestamp_seconds gauge",
+            f"django_setup_run_timestamp_seconds {time.time():.0f}",
+        ]
+        # The collector may read the file at any time, so it must be replaced atomically
+        tmp_path = f"{self._path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self._path)
+
+
+class Reporter:
+    def __init__(self, backends: t.List[ReportBackend]) -> None:
+        self.backends = backends
+        self._steps: t.List[ReportStep] = []
+        self._success = True
+        self._closed = False
+
+    def step_start(self, caption: str, ensured_name: t.Optional[str] = None) -> None:
+        step = ReportStep(caption, ensured_name)
+        for backend in self.backends:
+            backend.step_start(step, len(self._steps))
+        self._steps.append(step)
+
+    def step_wip(self, caption: str) -> None:
+        for backend in self.backends:
+            backend.step_wip(caption, len(self._steps))
+
+    def step_end(self, caption: str, changed: t.Optional[bool] = True) -> None:
+        step = self._steps.pop()
+        # "Ensuring" steps changed something if any of their sub-steps did
+        step_changed = step.changed if changed is None else changed
+        if step_changed and self._steps:
+            self._steps[-1].changed = True
+        duration = time.monotonic() - step.started_at
+        for backend in self.backends:
+            backend.step_end(step, caption, len(self._steps), step_changed, duration)
+
+    def message(self, caption: str, fatal: bool = False) -> None:
+        if fatal:
+            self._success = False
+        for backend in self.backends:
+            backend.message(caption, len(self._steps), fatal)
+
+    def subprocess_done(
+        self, cmd: Cmd, returncode: t.Optional[int], duration: float
+    ) -> None:
+        for backend in self.backends:
+            backend.subprocess_done(cmd, returncode, duration)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        for backend in self.backends:
+            backend.close(self._success)
+
+
+_reporter = Reporter([TreeReportBackend()])
+
+
+def _setup_report_backends() -> None:
+    if REPORT_JSON_EVENTS_PATH:
+        _reporter.backends.append(JsonEventsReportBackend(REPORT_JSON_EVENTS_PATH))
+    if REPORT_PROMETHEUS_TEXTFILE_PATH:
+        _reporter.backends.append(
+            PrometheusTextfileReportBackend(REPORT_PROMETHEUS_TEXTFILE_PATH)
+        )
+    # (also called when we `sys.exit()` in `_panic()`)
+    atexit.register(_reporter.close)
+
+
+def _report(*args, fatal: bool = False) -> None:
+    _reporter.message(" ".join(str(arg) for arg in args), fatal=fatal)
 
 
 def _panic(*args) -> None:
@@ -935,48 +2757,142 @@ def _panic(*args) -> None:
     sys.exit(1)
 
 
-# pylint: disable=protected-access
-_report._report_nb_levels = 0  # type: ignore
-# pylint: enable=protected-access
-
-
 @contextmanager
 def _ensuring_step(step_name: str) -> t.Generator[None, None, None]:
-    _report(f"Ensuring {step_name} setup...", step_start=True)
+    _reporter.step_start(f"Ensuring {step_name} setup...", ensured_name=step_name)
     yield
-    _report(f"{step_name} setup ok.\n", step_done=True)
+    _reporter.step_end(f"{step_name} setup ok.\n", changed=None)
 
 
 class StepReporter:
     @staticmethod
     def wip(caption: str) -> None:
-        _report(caption, step_wip=True)
+        _reporter.step_wip(caption)
 
     @staticmethod
     def nothing_to_do(caption: str) -> None:
-        _report(f"{caption} ✓", step_done=True)
+        _reporter.step_end(f"{caption} ✓", changed=False)
+
+    @staticmethod
+    def checked(caption: str) -> None:
+        # For the steps which only check something: whatever they found, nothing changed
+        _reporter.step_end(caption, changed=False)
 
     @staticmethod
     def done(caption: str) -> None:
-        _report(caption, step_done=True)
+        _reporter.step_end(caption, changed=True)
 
 
 @contextmanager
 def _step(step_init_caption: str) -> t.Generator[StepReporter, None, None]:
-    _report(step_init_caption, step_start=True)
+    _reporter.step_start(step_init_caption)
     yield StepReporter()
 
 
+_NETWORK_RETRY_BASE_DELAY_SECONDS = 2
+
 _NGINX_AVAILABLE_SITES_PATH = "/etc/nginx/sites-available"
 _NGINX_ENABLED_SITES_PATH = "/etc/nginx/sites-enabled"
 _NGINX_SITE_NAME = "django-app"
-_NGINX_SITE_FILE = f"""\
-# {_NGINX_AVAILABLE_SITES_PATH}/{_NGINX_SITE_NAME}
-
+_NGINX_MICROCACHE_PATH = "/var/cache/nginx/django-app"
+_NGINX_MICROCACHE_ZONE = "django_microcache"
+_NGINX_MICROCACHE_BACKEND = "127.0.0.1:8001"
+_NGINX_SERVER_NAME_DIRECTIVE = (
+    ("server_name " + NGINX_SERVER_NAME + ";") if NGINX_SERVER_NAME else ""
+)
+_NGINX_TLS_SESSION_ZONE = "django_tls_sessions"
+
+
+def _nginx_public_listen_directives() -> str:
+    if not NGINX_TLS_ENABLED:
+        return "listen 80;"
+    # HTTP/2 multiplexes all the requests of a page on a single connection, and resumed
+    # TLS sessions (from the shared cache, or from a ticket) skip the full handshake.
+    # @link https://nginx.org/en/docs/http/configuring_https_servers.html
+    return f"""\
+listen 443 ssl http2;
+
+    ssl_certificate {NGINX_TLS_CERTIFICATE_PATH};
+    ssl_certificate_key {NGINX_TLS_CERTIFICATE_KEY_PATH};
+    ssl_protocols TLSv1.2 TLSv1.3;
+    # 1MB of shared cache stores about 4000 sessions, for all the workers
+    ssl_session_cache shared:{_NGINX_TLS_SESSION_ZONE}:10m;
+    ssl_session_timeout 1d;
+    # (the tickets keys are generated by Nginx on each start, and live in memory only)
+    ssl_session_tickets on;
+    # (ignored, with a warning, for a self-signed certificate)
+    ssl_stapling on;
+    ssl_stapling_verify on;
+    resolver 127.0.0.53 valid=300s;
+    resolver_timeout 5s;
+
+    keepalive_timeout 75s;
+    keepalive_requests 1000;"""
+
+
+def _nginx_https_redirect_server_block() -> str:
+    return f"""
 server {{
-    {('server_name ' + NGINX_SERVER_NAME + ';') if NGINX_SERVER_NAME else ''}
+    {_NGINX_SERVER_NAME_DIRECTIVE}
     listen 80;
 
+    location / {{
+        return 301 https://$host$request_uri;
+    }}
+}}
+"""
+
+
+def _nginx_microcache_server_blocks() -> str:
+    # When micro-caching is enabled, a caching proxy listens on port 80 and forwards
+    # cache misses to the Passenger server, which then only listens on localhost.
+    # @link https://www.nginx.com/blog/benefits-of-microcaching-nginx/
+    keys_zone_size, max_size = nginx_microcache_zone_sizes(_NGINX_MICROCACHE_PATH)
+    return f"""
+proxy_cache_path {_NGINX_MICROCACHE_PATH} levels=1:2 keys_zone={_NGINX_MICROCACHE_ZONE}:{keys_zone_size}m max_size={max_size}m inactive=10m use_temp_path=off;
+
+# Requests with cookies (Django sessions, CSRF...) or credentials are never cached
+map "$http_cookie$http_authorization" $django_microcache_bypass {{
+    default 1;
+    "" 0;
+}}
+
+server {{
+    {_NGINX_SERVER_NAME_DIRECTIVE}
+    {_nginx_public_listen_directives()}
+
+    location / {{
+        proxy_pass http://{_NGINX_MICROCACHE_BACKEND};
+        proxy_set_header Host $host;
+        proxy_set_header X-Real-IP $remote_addr;
+        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Proto $scheme;
+
+        proxy_cache {_NGINX_MICROCACHE_ZONE};
+        proxy_cache_valid 200 301 302 {NGINX_MICROCACHE_SECONDS}s;
+        proxy_cache_bypass $django_microcache_bypass;
+        proxy_no_cache $django_microcache_bypass;
+        # Only one request per cache key goes to the app, the others wait for it...
+        proxy_cache_lock on;
+        proxy_cache_lock_timeout 5s;
+        # ...or get the stale response while the cache entry is being refreshed
+        proxy_cache_use_stale updating error timeout http_500 http_502 http_503 http_504;
+        proxy_cache_background_update on;
+        add_header X-Cache-Status $upstream_cache_status;
+    }}
+}}
+"""
+
+
+@lru_cache(maxsize=None)
+def _nginx_site_file() -> str:
+    return f"""\
+# {_NGINX_AVAILABLE_SITES_PATH}/{_NGINX_SITE_NAME}
+{_nginx_https_redirect_server_block() if NGINX_TLS_ENABLED else ''}{_nginx_microcache_server_blocks() if NGINX_MICROCACHE_SECONDS else ''}
+server {{
+    {'' if NGINX_MICROCACHE_SECONDS else _NGINX_SERVER_NAME_DIRECTIVE}
+    {('listen ' + _NGINX_MICROCACHE_BACKEND + ';') if NGINX_MICROCACHE_SECONDS else _nginx_public_listen_directives()}
+
     location = /favicon.ico {{ access_log off; log_not_found off; }}
 
     location / {{
@@ -984,18 +2900,277 @@ server {{
         passenger_app_type wsgi;
         # passenger_startup_file passenger_wsgi.py;
         
-        passenger_python /usr/bin/python{TARGET_PYTHON_VERSION};
-        root {DJANGO_APP_DIR}/static;
+        passenger_python {DJANGO_APP_VENV_DIR}/bin/python;
+        root {DJANGO_APP_STATIC_DIR};
+        # Serves the ".gz" version of the static files when there is one
+        gzip_static on;
+    }}
+}}
+
+"""
+
+
+_NGINX_STATUS_SITE_NAME = "django-app-status"
+_NGINX_STATUS_PORT = "8080"
+
+
+@lru_cache(maxsize=None)
+def _nginx_status_site_file() -> str:
+    return f"""\
+# {_NGINX_AVAILABLE_SITES_PATH}/{_NGINX_STATUS_SITE_NAME}
+
+server {{
+    listen 127.0.0.1:{_NGINX_STATUS_PORT};
+
+    location = /nginx_status {{
+        stub_status;
+        access_log off;
     }}
 }}
 
 """
 
-_PASSENGER_WSGI_FILE = f"""\
+
+_NODE_EXPORTER_PORT = "9100"
+
+
+@lru_cache(maxsize=None)
+def _node_exporter_defaults_file() -> str:
+    return f"""\
+# /etc/default/prometheus-node-exporter
+ARGS="--web.listen-address=127.0.0.1:{_NODE_EXPORTER_PORT} --collector.textfile.directory=/var/lib/prometheus/node-exporter"
+"""
+
+
+_POSTGRES_EXPORTER_PORT = "9187"
+
+
+@lru_cache(maxsize=None)
+def _postgres_exporter_defaults_file() -> str:
+    return f"""\
+# /etc/default/prometheus-postgres-exporter
+DATA_SOURCE_NAME="user=prometheus host=/run/postgresql dbname=postgres"
+ARGS="--web.listen-address=127.0.0.1:{_POSTGRES_EXPORTER_PORT}"
+"""
+
+
+_POSTGRES_CONF_DIR = f"/etc/postgresql/{TARGET_POSTGRES_VERSION}/main/conf.d"
+
+
+@lru_cache(maxsize=None)
+def _postgres_monitoring_conf_file() -> str:
+    return f"""\
+# {_POSTGRES_CONF_DIR}/monitoring.conf
+
+log_min_duration_statement = {POSTGRES_LOG_MIN_DURATION_MS}
+track_io_timing = on
+"""
+
+
+_POSTGRES_SYNCHRONOUS_COMMIT_VALUES = ("on", "off", "local", "remote_write")
+
+
+@lru_cache(maxsize=None)
+def _postgres_tuning_conf_file() -> str:
+    return f"""\
+# {_POSTGRES_CONF_DIR}/tuning.conf
+
+# Django apps update and delete rows a lot: autovacuum must keep up with the dead tuples
+# before the tables and their indexes bloat.
+autovacuum_max_workers = 4
+autovacuum_naptime = 15s
+autovacuum_vacuum_scale_factor = 0.05
+autovacuum_analyze_scale_factor = 0.02
+autovacuum_vacuum_cost_limit = 1000
+autovacuum_vacuum_cost_delay = 10ms
+
+# Fewer and smoother checkpoints, rather than latency spikes every 5 minutes
+checkpoint_timeout = 15min
+checkpoint_completion_target = 0.9
+max_wal_size = 2GB
+min_wal_size = 256MB
+wal_compression = on
+synchronous_commit = {POSTGRES_SYNCHRONOUS_COMMIT}
+
+shared_preload_libraries = 'pg_stat_statements'
+pg_stat_statements.track = top
+"""
+
+
+# (only the queries of the current database, which are the ones of the app)
+_POSTGRES_REPORT_TOP_QUERIES_SQL = """\
+select round(total_time::numeric, 1) as total_ms, calls,
+  round(mean_time::numeric, 2) as mean_ms,
+  round((100 * total_time / nullif(sum(total_time) over (), 0))::numeric, 1) as percent,
+  left(regexp_replace(query, '\\s+', ' ', 'g'), 80) as query
+from pg_stat_statements
+where dbid = (select oid from pg_database where datname = current_database())
+order by total_time desc limit 10;
+"""
+
+# An estimate from the dead tuples that autovacuum has not reclaimed yet
+_POSTGRES_REPORT_TABLE_BLOAT_SQL = """\
+select relname as table, pg_size_pretty(pg_total_relation_size(relid)) as size,
+  n_live_tup as live, n_dead_tup as dead,
+  round(100.0 * n_dead_tup / nullif(n_live_tup + n_dead_tup, 0), 1) as dead_percent,
+  greatest(last_vacuum, last_autovacuum) as last_vacuum
+from pg_stat_user_tables
+order by n_dead_tup desc limit 10;
+"""
+
+_POSTGRES_REPORT_INDEX_HIT_SQL = """\
+select t.relname as table,
+  round(100.0 * t.idx_scan / nullif(t.seq_scan + t.idx_scan, 0), 1) as index_scans_percent,
+  round(100.0 * io.idx_blks_hit / nullif(io.idx_blks_hit + io.idx_blks_read, 0), 1) as index_hit_percent,
+  round(100.0 * io.heap_blks_hit / nullif(io.heap_blks_hit + io.heap_blks_read, 0), 1) as table_hit_percent
+from pg_stat_user_tables t join pg_statio_user_tables io using (relid)
+order by t.seq_scan + t.idx_scan desc limit 10;
+"""
+
+_PYTHON_APP_DEFAULT_PACKAGES = ("django", "psycopg2-binary")
+_PYTHON_SYNCED_LOCKFILE_HASH_FILE_NAME = ".synced-lockfile.sha256"
+_PYTHON_COMPILED_SOURCES_HASH_FILE_NAME = ".compiled-sources.sha256"
+
+_FRONTEND_PUBLISHED_SOURCES_HASH_FILE_NAME = ".frontend-sources.sha256"
+_FRONTEND_COMPRESSED_EXTENSIONS = ("js", "css", "svg", "json", "map", "html", "txt")
+
+_SWAP_FILE_PATH = "/swapfile"
+_MEMORY_SYSCTL_FILE_PATH = "/etc/sysctl.d/60-django-app-memory.conf"
+
+
+@lru_cache(maxsize=None)
+def _memory_sysctl_file() -> str:
+    return f"""\
+# {_MEMORY_SYSCTL_FILE_PATH}
+
+# Only swap when we really have to: Postgres and the app workers are latency-sensitive
+vm.swappiness = 10
+# Keep the filesystem metadata (Python modules, static files...) in cache a bit longer
+vm.vfs_cache_pressure = 50
+"""
+
+
+@lru_cache(maxsize=None)
+def _postgres_memory_drop_in_file() -> str:
+    return f"""\
+# /etc/systemd/system/postgresql@{TARGET_POSTGRES_VERSION}-main.service.d/memory.conf
+
+[Service]
+# The postmaster is never OOM-killed, while its backends go back to the default score
+# @link https://www.postgresql.org/docs/10/kernel-resources.html#LINUX-MEMORY-OVERCOMMIT
+OOMScoreAdjust=-1000
+Environment=PG_OOM_ADJUST_FILE=/proc/self/oom_score_adj
+Environment=PG_OOM_ADJUST_VALUE=0
+"""
+
+
+@lru_cache(maxsize=None)
+def _nginx_memory_drop_in_file() -> str:
+    return """\
+# /etc/systemd/system/nginx.service.d/memory.conf
+
+[Service]
+# Nginx and the Passenger app workers it spawns are the first ones to be OOM-killed
+OOMScoreAdjust=500
+"""
+
+
+@lru_cache(maxsize=None)
+def _passenger_wsgi_file() -> str:
+    return f"""\
 import {DJANGO_PROJECT_NAME}.wsgi
 
 application = {DJANGO_PROJECT_NAME}.wsgi.application
 """
 
+
+def main(argv: t.List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Provisions an Ubuntu server for a Django app."
+    )
+    parser.add_argument(
+        "--record-commands",
+        metavar="PATH",
+        help="record every command and file access of the run, to replay it with `benchmark.py --replay`",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the steps completed by the previous run (once their post-conditions are checked), up to the first incomplete one",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("setup", help="set up the server (default command)")
+    subparsers.add_parser(
+        "bake",
+        help="only run the steps which are not specific to this server, then clean it up to be snapshotted as an image",
+    )
+    subparsers.add_parser(
+        "personalize",
+        help="only run the steps specific to this server, which was booted from a baked image",
+    )
+    plan_parser = subparsers.add_parser(
+        "plan",
+        help="list the setup steps (and the ones completed by a previous run), without running anything",
+    )
+    plan_parser.add_argument(
+        "--phase",
+        choices=[phase.value for phase in SetupPhase],
+        help="only list the steps of this phase",
+    )
+    subparsers.add_parser(
+        "purge-cache", help="purge the Nginx micro-cache (see NGINX_MICROCACHE_SECONDS)"
+    )
+    subparsers.add_parser(
+        "deploy",
+        help="sync the app packages, compile its bytecode and build its frontend assets (to run after a code update)",
+    )
+    precompile_parser = subparsers.add_parser(
+        "precompile",
+        help="compile the app and site-packages Python bytecode (to run after a deploy)",
+    )
+    precompile_parser.add_argument(
+        "--importtime",
+        action="store_true",
+        help="also report the slowest imports of the WSGI entry point",
+    )
+    subparsers.add_parser(
+        "db-report",
+        help="print the top queries by total time, the tables bloat and the index hit ratios of the app database",
+    )
+    args = parser.parse_args(argv)
+
+    _setup_report_backends()
+    if args.record_commands:
+        global _executor  # pylint: disable=global-statement
+        _executor = RecordingExecutor(_executor, args.record_commands)
+
+    try:
+        if args.command in (None, "setup"):
+            setup_server(resume=args.resume)
+        elif args.command == "bake":
+            bake_image(resume=args.resume)
+        elif args.command == "personalize":
+            personalize_server(resume=args.resume)
+        elif args.command == "plan":
+            print_plan((SetupPhase(args.phase),) if args.phase else tuple(SetupPhase))
+        elif args.command == "purge-cache":
+            nginx_purge_microcache(_NGINX_MICROCACHE_PATH)
+        elif args.command == "deploy":
+            ensure_python_app_packages_setup()
+            ensure_python_bytecode()
+            ensure_frontend_assets()
+        elif args.command == "precompile":
+            ensure_python_bytecode()
+            if args.importtime:
+                python_report_import_times(DJANGO_APP_DIR, DJANGO_PROJECT_NAME)
+        elif args.command == "db-report":
+            postgres_report(POSTGRES_DB)
+    except (Exception, KeyboardInterrupt) as exception:
+        # (`_panic()` already reported its failure: this is for the unexpected ones, so that
+        # the reports don't claim the run succeeded)
+        _report(f"Unexpected error: {exception!r}", fatal=True)
+        raise
+
+
 if __name__ == "__main__":
-    setup_server()
+    main(sys.argv[1:])